@@ -2,19 +2,46 @@
 import os
 import subprocess
 import concurrent.futures
-from threading import Lock
+from threading import Lock, BoundedSemaphore
 import time
 import shutil
+import hashlib
+import json
 
 # Lock para sincronizar prints
 print_lock = Lock()
 
+# Recortes (CPU, locais ou remotos) limitados separadamente dos downloads (rede)
+MAX_DECODE_WORKERS = 2
+decode_slots = BoundedSemaphore(MAX_DECODE_WORKERS)
+
+# Caminhos absolutos resolvidos uma única vez (sem busca no PATH a cada execução)
+SAMTOOLS = shutil.which("samtools")
+WGET = shutil.which("wget")
+
+# Threads de decodificação CRAM / compressão BGZF por samtools (total ≈ núcleos)
+SAMTOOLS_THREADS = max(2, (os.cpu_count() or 2) // MAX_DECODE_WORKERS - 1)
+
+# Registro de receitas já executadas (chave -> BAM), gravado em output_dir
+RECIPE_FILE = ".recipe.json"
+recipe_lock = Lock()
+
 def safe_print(*args, **kwargs):
     """Print thread-safe"""
     with print_lock:
         print(*args, **kwargs)
 
-def run_command(cmd, timeout=None, description="comando"):
+def _log_tail(log_path, max_bytes=2048):
+    """Lê apenas o final de um arquivo de log"""
+    try:
+        with open(log_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - max_bytes))
+            return f.read().decode(errors="replace")
+    except OSError:
+        return ""
+
+def run_command(cmd, timeout=None, description="comando", log_path=None):
     """
     Executa um comando e retorna o resultado
     
@@ -22,24 +49,98 @@ def run_command(cmd, timeout=None, description="comando"):
         cmd: Lista com comando e argumentos
         timeout: Timeout em segundos
         description: Descrição para logs
+        log_path: Se definido, stdout/stderr vão para este arquivo em vez da
+                  memória (para comandos longos e verbosos como o wget)
     
     Returns:
         tuple: (success, stdout, stderr, returncode)
+        Com log_path, stdout é vazio e stderr traz apenas o final do log.
     """
     try:
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=timeout,
-            check=False
-        )
-        return True, result.stdout, result.stderr, result.returncode
+        if log_path is None:
+            result = subprocess.run(
+                cmd,
+                capture_output=True,
+                text=True,
+                timeout=timeout,
+                check=False,
+                close_fds=False  # Nossos descritores já são não-herdáveis (PEP 446)
+            )
+            return True, result.stdout, result.stderr, result.returncode
+        
+        with open(log_path, "w") as log:
+            result = subprocess.run(
+                cmd,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                timeout=timeout,
+                check=False,
+                close_fds=False
+            )
+        return True, "", _log_tail(log_path), result.returncode
     except subprocess.TimeoutExpired:
         return False, "", f"Timeout de {timeout}s excedido", -1
     except Exception as e:
         return False, "", str(e), -1
 
+def recipe_base_digest(bed_file):
+    """
+    Calcula a parte da chave de cache comum a todas as amostras
+    
+    Combina o conteúdo do BED com a versão do samtools: se qualquer um
+    mudar, todas as chaves mudam e os BAMs são refeitos.
+    
+    Args:
+        bed_file: Arquivo BED com regiões
+    
+    Returns:
+        str: Digest sha256 em hexadecimal
+    """
+    digest = hashlib.sha256()
+    with open(bed_file, "rb") as f:
+        digest.update(f.read())
+    _, stdout, _, _ = run_command([SAMTOOLS, "--version"], timeout=30)
+    digest.update(stdout.split("\n", 1)[0].encode())
+    return digest.hexdigest()
+
+def recipe_key(url, base_digest):
+    """Chave endereçada por conteúdo de uma amostra: (URL, BED, samtools)"""
+    return hashlib.sha256(f"{url}\0{base_digest}".encode()).hexdigest()
+
+def load_recipes(output_dir):
+    """
+    Carrega o registro de receitas já executadas
+    
+    Returns:
+        dict: chave -> caminho do BAM
+    """
+    try:
+        with open(os.path.join(output_dir, RECIPE_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_recipe(recipes, output_dir, key, bam_path):
+    """Registra uma amostra concluída e regrava o registro de forma atômica"""
+    recipe_path = os.path.join(output_dir, RECIPE_FILE)
+    with recipe_lock:
+        recipes[key] = bam_path
+        tmp_path = recipe_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(recipes, f, indent=1)
+        os.replace(tmp_path, recipe_path)
+
+def _sample_id(url):
+    """Extrai o ID da amostra (HGDP00704.alt_bwamem... -> HGDP00704) de uma URL ou caminho"""
+    return url.rsplit("/", 1)[-1].partition(".")[0]
+
+def _stat(path):
+    """os.stat que retorna None se o arquivo não existir (uma única syscall)"""
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
 def download_cram_with_index(url, download_dir, max_retries=3):
     """
     Baixa arquivo CRAM e seu índice usando wget com retry
@@ -53,29 +154,44 @@ def download_cram_with_index(url, download_dir, max_retries=3):
         tuple: (success, cram_path, crai_path, message)
     """
     filename = os.path.basename(url)
-    sample_id = filename.split(".")[0]
+    sample_id = _sample_id(filename)
     cram_path = os.path.join(download_dir, filename)
     crai_path = cram_path + ".crai"
     crai_url = url + ".crai"
+    log_path = os.path.join(download_dir, f"{sample_id}.wget.log")
     
-    # Verificar se arquivos já existem
-    if os.path.exists(cram_path) and os.path.exists(crai_path):
-        # Verificar integridade básica (tamanho > 0)
-        try:
-            if os.path.getsize(cram_path) > 0 and os.path.getsize(crai_path) > 0:
-                return True, cram_path, crai_path, "Arquivos já existem"
-        except:
-            pass
+    # Verificar se arquivos já existem e têm tamanho > 0
+    cram_st, crai_st = _stat(cram_path), _stat(crai_path)
+    if cram_st and crai_st and cram_st.st_size > 0 and crai_st.st_size > 0:
+        return True, cram_path, crai_path, "Arquivos já existem"
     
     # Tentar download com retry
     for attempt in range(max_retries):
+        crai_proc = None
         try:
             safe_print(f"[DOWNLOAD] {sample_id}: Tentativa {attempt + 1}/{max_retries}")
             
+            # Download do índice CRAI em segundo plano, sobreposto ao do CRAM
+            safe_print(f"[DOWNLOAD] {sample_id}: Baixando CRAM e índice CRAI...")
+            crai_cmd = [
+                WGET, 
+                "--continue",
+                "--timeout=60",
+                "--tries=3",
+                "--waitretry=10",
+                "--no-verbose",
+                "-O", crai_path,
+                crai_url
+            ]
+            crai_proc = subprocess.Popen(
+                crai_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+            )
+            
             # Download do arquivo CRAM
-            safe_print(f"[DOWNLOAD] {sample_id}: Baixando CRAM...")
+            # O wget grava direto no arquivo: os bytes do CRAM nunca passam
+            # pelo Python, então não há cópia extra a eliminar neste caminho
             cram_cmd = [
-                "wget", 
+                WGET, 
                 "--continue",           # Continuar downloads interrompidos
                 "--timeout=300",        # Timeout de conexão: 5 min
                 "--tries=3",           # Tentativas internas do wget
@@ -86,66 +202,52 @@ def download_cram_with_index(url, download_dir, max_retries=3):
             ]
             
             success, stdout, stderr, returncode = run_command(
-                cram_cmd, timeout=7200, description=f"download CRAM {sample_id}"  # 2 horas
+                cram_cmd, timeout=7200, description=f"download CRAM {sample_id}",  # 2 horas
+                log_path=log_path
             )
             
+            # O CRAI é pequeno: normalmente já terminou junto com o CRAM
+            try:
+                _, crai_stderr = crai_proc.communicate(timeout=600)  # 10 min
+                crai_ok = crai_proc.returncode == 0
+            except subprocess.TimeoutExpired:
+                crai_proc.kill()
+                crai_proc.communicate()
+                crai_stderr, crai_ok = "Timeout de 600s excedido", False
+            
             if not success or returncode != 0:
                 safe_print(f"[AVISO] {sample_id}: Falha no download CRAM: {stderr}")
                 # Limpar arquivo parcial se existir
-                if os.path.exists(cram_path):
-                    try:
-                        os.remove(cram_path)
-                    except:
-                        pass
+                secure_delete_file(cram_path)
                 continue
             
-            # Download do índice CRAI
-            safe_print(f"[DOWNLOAD] {sample_id}: Baixando índice CRAI...")
-            crai_cmd = [
-                "wget", 
-                "--continue",
-                "--timeout=60",
-                "--tries=3",
-                "--waitretry=10",
-                "--progress=dot:mega",
-                "-O", crai_path,
-                crai_url
-            ]
-            
-            success, stdout, stderr, returncode = run_command(
-                crai_cmd, timeout=600, description=f"download CRAI {sample_id}"  # 10 min
-            )
-            
-            if not success or returncode != 0:
-                safe_print(f"[AVISO] {sample_id}: Falha no download CRAI: {stderr}")
+            if not crai_ok:
+                safe_print(f"[AVISO] {sample_id}: Falha no download CRAI: {crai_stderr}")
                 # Limpar arquivos se CRAI falhou
-                for f in [cram_path, crai_path]:
-                    if os.path.exists(f):
-                        try:
-                            os.remove(f)
-                        except:
-                            pass
+                secure_delete_file(cram_path)
+                secure_delete_file(crai_path)
                 continue
             
             # Verificar se ambos arquivos foram baixados com sucesso
-            if os.path.exists(cram_path) and os.path.exists(crai_path):
-                cram_size = os.path.getsize(cram_path)
-                crai_size = os.path.getsize(crai_path)
+            cram_st, crai_st = _stat(cram_path), _stat(crai_path)
+            if cram_st and crai_st:
+                cram_size = cram_st.st_size
+                crai_size = crai_st.st_size
                 
                 if cram_size > 1024 and crai_size > 0:  # Tamanhos mínimos razoáveis
+                    secure_delete_file(log_path)
                     return True, cram_path, crai_path, f"Download concluído (CRAM: {cram_size/1024/1024:.1f}MB, CRAI: {crai_size/1024:.1f}KB)"
                 else:
                     safe_print(f"[AVISO] {sample_id}: Arquivos com tamanhos suspeitos (CRAM: {cram_size}, CRAI: {crai_size})")
             
         except Exception as e:
             safe_print(f"[AVISO] {sample_id}: Erro na tentativa {attempt + 1}: {str(e)}")
+            if crai_proc is not None and crai_proc.poll() is None:
+                crai_proc.kill()
+                crai_proc.communicate()
             # Limpar arquivos parciais
-            for f in [cram_path, crai_path]:
-                if os.path.exists(f):
-                    try:
-                        os.remove(f)
-                    except:
-                        pass
+            secure_delete_file(cram_path)
+            secure_delete_file(crai_path)
         
         # Esperar entre tentativas
         if attempt < max_retries - 1:
@@ -153,9 +255,41 @@ def download_cram_with_index(url, download_dir, max_retries=3):
             safe_print(f"[INFO] {sample_id}: Aguardando {delay}s antes da próxima tentativa...")
             time.sleep(delay)
     
-    return False, None, None, f"Falha no download após {max_retries} tentativas"
+    return False, None, None, f"Falha no download após {max_retries} tentativas (log: {log_path})"
+
+def configure_ref_cache(ref_fasta, ref_cache):
+    """
+    Prepara o cache local de referência (REF_CACHE/REF_PATH) do htslib
+    
+    Sem isso, cada decodificação de CRAM busca as sequências de referência
+    por MD5 no servidor da EBI. O cache é populado uma única vez a partir do
+    FASTA local e as variáveis de ambiente são herdadas pelos subprocessos.
+    
+    Args:
+        ref_fasta: FASTA de referência (GRCh38)
+        ref_cache: Diretório raiz do cache
+    """
+    os.makedirs(ref_cache, exist_ok=True)
+    
+    if not os.listdir(ref_cache):
+        populate = shutil.which("seq_cache_populate.pl")
+        if populate:
+            print(f"[INFO] Populando cache de referência em {ref_cache} (apenas na primeira execução)...")
+            success, _, stderr, returncode = run_command(
+                [populate, "-root", ref_cache, ref_fasta],
+                timeout=7200, description="seq_cache_populate"
+            )
+            if not success or returncode != 0:
+                print(f"[AVISO] Falha ao popular cache de referência: {stderr}")
+        else:
+            print("[AVISO] seq_cache_populate.pl não encontrado; cache será preenchido sob demanda")
+    
+    cache_pattern = os.path.join(ref_cache, "%2s", "%2s", "%s")
+    os.environ["REF_CACHE"] = cache_pattern
+    # Local primeiro, servidor da EBI apenas como último recurso
+    os.environ["REF_PATH"] = f"{cache_pattern}:http://www.ebi.ac.uk/ena/cram/md5/%s"
 
-def process_cram_to_bam(cram_path, crai_path, bed_file, output_bam):
+def process_cram_to_bam(cram_path, crai_path, bed_file, output_bam, ref_fasta):
     """
     Processa arquivo CRAM para BAM usando regiões do BED
     
@@ -164,21 +298,25 @@ def process_cram_to_bam(cram_path, crai_path, bed_file, output_bam):
         crai_path: Caminho do arquivo de índice CRAI
         bed_file: Arquivo BED com regiões
         output_bam: Caminho de saída do BAM
+        ref_fasta: FASTA de referência usado para decodificar o CRAM
     
     Returns:
         tuple: (success, message)
     """
-    sample_id = os.path.basename(cram_path).split(".")[0]
+    sample_id = _sample_id(cram_path)
     
     try:
         safe_print(f"[PROCESS] {sample_id}: Recortando regiões do CRAM...")
         
         # Comando samtools view
         cmd = [
-            "samtools", "view",
+            SAMTOOLS, "view",
+            "-@", str(SAMTOOLS_THREADS),  # Decodificação/compressão multithread
             "-b",              # Saída em formato BAM
+            "--reference", ref_fasta,  # Evita buscar a referência na EBI
             "-ML", bed_file,   # Filtrar usando arquivo BED
-            "-o", output_bam,  # Arquivo de saída
+            "--write-index",   # Índice gerado na mesma passada (valida o EOF do BGZF)
+            "-o", f"{output_bam}##idx##{output_bam}.bai",  # Arquivo de saída e índice
             cram_path          # Arquivo CRAM de entrada
         ]
         
@@ -192,27 +330,81 @@ def process_cram_to_bam(cram_path, crai_path, bed_file, output_bam):
             return False, f"Erro no samtools: {stderr}"
         
         # Verificar se o BAM foi gerado corretamente
-        if not os.path.exists(output_bam):
+        bam_st = _stat(output_bam)
+        if bam_st is None:
             return False, "Arquivo BAM não foi criado"
         
-        bam_size = os.path.getsize(output_bam)
+        bam_size = bam_st.st_size
         if bam_size < 1024:  # Menos de 1KB é suspeito
             return False, f"Arquivo BAM muito pequeno ({bam_size} bytes)"
         
-        # Validar BAM usando samtools quickcheck
-        cmd_check = ["samtools", "quickcheck", output_bam]
-        success_check, _, stderr_check, returncode_check = run_command(
-            cmd_check, timeout=60, description=f"quickcheck {sample_id}"
-        )
-        
-        if not success_check or returncode_check != 0:
-            return False, f"BAM corrompido (quickcheck falhou): {stderr_check}"
-        
         return True, f"Processamento concluído em {elapsed:.1f}s (BAM: {bam_size/1024/1024:.2f}MB)"
         
     except Exception as e:
         return False, f"Erro durante processamento: {str(e)}"
 
+def stream_cram_to_bam(url, bed_file, output_bam, ref_fasta, max_retries=3):
+    """
+    Recorta as regiões do BED lendo o CRAM remoto diretamente pela URL
+    
+    O htslib usa o CRAI remoto para fazer requisições por intervalo de bytes,
+    então apenas os slices que cobrem o BED são transferidos, sem materializar
+    o CRAM inteiro em disco.
+    
+    Args:
+        url: URL do arquivo CRAM
+        bed_file: Arquivo BED com regiões
+        output_bam: Caminho de saída do BAM
+        ref_fasta: FASTA de referência usado para decodificar o CRAM
+        max_retries: Número máximo de tentativas
+    
+    Returns:
+        tuple: (success, message)
+    """
+    sample_id = _sample_id(url)
+    
+    cmd = [
+        SAMTOOLS, "view",
+        "-@", str(SAMTOOLS_THREADS),  # Decodificação/compressão multithread
+        "-b",                      # Saída em formato BAM
+        "--reference", ref_fasta,  # Evita buscar a referência na EBI
+        "-ML", bed_file,           # Filtrar usando arquivo BED
+        "--write-index",           # Índice gerado na mesma passada
+        "-o", f"{output_bam}##idx##{output_bam}.bai",  # Arquivo de saída e índice
+        "-X", url, url + ".crai"   # CRAM remoto e seu índice
+    ]
+    
+    for attempt in range(max_retries):
+        safe_print(f"[STREAM] {sample_id}: Tentativa {attempt + 1}/{max_retries}")
+        
+        # Decodificação com -@ SAMTOOLS_THREADS: ocupa uma vaga de recorte como
+        # o caminho local (a espera entre tentativas fica fora da vaga)
+        with decode_slots:
+            start_time = time.time()
+            success, stdout, stderr, returncode = run_command(
+                cmd, timeout=3600, description=f"samtools view remoto {sample_id}"  # 1 hora
+            )
+            elapsed = time.time() - start_time
+        
+        bam_st = _stat(output_bam) if success and returncode == 0 else None
+        if bam_st:
+            bam_size = bam_st.st_size
+            if bam_size >= 1024:
+                return True, f"Recorte remoto concluído em {elapsed:.1f}s (BAM: {bam_size/1024/1024:.2f}MB)"
+            stderr = f"Arquivo BAM muito pequeno ({bam_size} bytes)"
+        
+        safe_print(f"[AVISO] {sample_id}: Falha no recorte remoto: {stderr}")
+        secure_delete_file(output_bam)
+        secure_delete_file(output_bam + ".bai")
+        
+        # Esperar entre tentativas
+        if attempt < max_retries - 1:
+            delay = min(60 * (attempt + 1), 300)  # Até 5 min
+            safe_print(f"[INFO] {sample_id}: Aguardando {delay}s antes da próxima tentativa...")
+            time.sleep(delay)
+    
+    return False, f"Falha no recorte remoto após {max_retries} tentativas"
+
 def secure_delete_file(file_path):
     """
     Remove arquivo de forma segura e definitiva
@@ -224,24 +416,30 @@ def secure_delete_file(file_path):
         bool: True se removido com sucesso
     """
     try:
-        if os.path.exists(file_path):
-            # Remover arquivo definitivamente
-            os.remove(file_path)
-            return True
+        os.remove(file_path)
+        return True
+    except FileNotFoundError:
         return True  # Se não existe, considerar como sucesso
     except Exception as e:
         safe_print(f"[ERRO] Falha ao remover {file_path}: {e}")
         return False
 
-def process_single_sample(url, bed_file, output_dir, temp_dir):
+def process_single_sample(url, bed_file, output_dir, temp_dir, ref_fasta, recipes, base_digest):
     """
-    Processa uma única amostra: download -> recorte -> limpeza
+    Processa uma única amostra: recorte remoto ou download -> recorte -> limpeza
+    
+    Primeiro tenta recortar o CRAM direto pela URL; o download completo
+    para o diretório temporário fica apenas como alternativa caso o acesso
+    remoto do htslib falhe.
     
     Args:
         url: URL do arquivo CRAM
         bed_file: Arquivo BED com regiões
         output_dir: Diretório de saída dos BAMs
         temp_dir: Diretório temporário para CRAMs
+        ref_fasta: FASTA de referência usado para decodificar o CRAM
+        recipes: Registro de receitas já executadas (ver load_recipes)
+        base_digest: Parte comum da chave de cache (ver recipe_base_digest)
     
     Returns:
         tuple: (success, sample_id, message)
@@ -249,17 +447,30 @@ def process_single_sample(url, bed_file, output_dir, temp_dir):
     if not url.strip():
         return False, "", "URL vazia"
     
-    filename = os.path.basename(url.strip())
-    sample_id = filename.split(".")[0]
+    sample_id = _sample_id(url.strip())
     output_bam = os.path.join(output_dir, f"{sample_id}.bam")
+    key = recipe_key(url.strip(), base_digest)
+    
+    # Mesma URL, mesmo BED e mesmo samtools: nada a refazer
+    if recipes.get(key) == output_bam and os.path.exists(output_bam):
+        return True, sample_id, "BAM já existe (registro de receitas)"
     
     # Verificar se BAM já existe e está válido
     if os.path.exists(output_bam):
-        cmd_check = ["samtools", "quickcheck", output_bam]
+        cmd_check = [SAMTOOLS, "quickcheck", output_bam]
         success, _, _, returncode = run_command(cmd_check, timeout=30)
         if success and returncode == 0:
+            save_recipe(recipes, output_dir, key, output_bam)
             return True, sample_id, "BAM válido já existe"
     
+    # Recorte remoto: transfere apenas os slices que cobrem o BED
+    success, stream_msg = stream_cram_to_bam(url.strip(), bed_file, output_bam, ref_fasta)
+    if success:
+        save_recipe(recipes, output_dir, key, output_bam)
+        return True, sample_id, stream_msg
+    
+    safe_print(f"[AVISO] {sample_id}: {stream_msg}; usando download completo do CRAM")
+    
     try:
         # Etapa 1: Download do CRAM e índice
         success, cram_path, crai_path, download_msg = download_cram_with_index(
@@ -271,8 +482,9 @@ def process_single_sample(url, bed_file, output_dir, temp_dir):
         
         safe_print(f"[INFO] {sample_id}: {download_msg}")
         
-        # Etapa 2: Processar CRAM para BAM
-        success, process_msg = process_cram_to_bam(cram_path, crai_path, bed_file, output_bam)
+        # Etapa 2: Processar CRAM para BAM (não ocupa a vaga de rede de outra amostra)
+        with decode_slots:
+            success, process_msg = process_cram_to_bam(cram_path, crai_path, bed_file, output_bam, ref_fasta)
         
         if not success:
             # Limpar arquivos temporários em caso de erro
@@ -292,6 +504,7 @@ def process_single_sample(url, bed_file, output_dir, temp_dir):
         else:
             cleanup_msg = "Aviso: Alguns arquivos temporários não foram removidos"
         
+        save_recipe(recipes, output_dir, key, output_bam)
         return True, sample_id, f"Concluído com sucesso. {cleanup_msg}"
         
     except Exception as e:
@@ -308,9 +521,11 @@ def main():
     output_dir = "/home/lab/Desktop/arq_joao/ANCESTRY_PANEL/BAMs"
     temp_dir = "/home/lab/Desktop/arq_joao/ANCESTRY_PANEL/temp_crams"
     links_file = "/home/lab/Desktop/arq_joao/ANCESTRY_PANEL/1kg_hgdp_cram.txt"
+    ref_fasta = "/home/lab/Desktop/arq_joao/NativoAmericanas/reference/GRCh38_full_analysis_set_plus_decoy_hla.fa"
+    ref_cache = "/home/lab/Desktop/arq_joao/ANCESTRY_PANEL/ref_cache"
     
     # Configurações de processamento
-    MAX_WORKERS = 2  # Processar 2 amostras simultaneamente
+    MAX_WORKERS = 4  # Amostras simultâneas na rede (recortes limitados por MAX_DECODE_WORKERS)
     
     # Criar diretórios
     os.makedirs(output_dir, exist_ok=True)
@@ -330,18 +545,28 @@ def main():
         return
     
     print(f"[INFO] Encontradas {len(urls)} amostras para processar")
-    print(f"[INFO] Usando {MAX_WORKERS} processos paralelos")
+    print(f"[INFO] Usando {MAX_WORKERS} amostras paralelas ({MAX_DECODE_WORKERS} recortes simultâneos)")
     print(f"[INFO] Arquivos temporários em: {temp_dir}")
     print(f"[INFO] Arquivos finais em: {output_dir}")
     print("-" * 80)
     
     # Verificar dependências
-    for tool in ["wget", "samtools"]:
-        success, _, stderr, returncode = run_command(["which", tool], timeout=10)
-        if not success or returncode != 0:
+    for tool, path in [("wget", WGET), ("samtools", SAMTOOLS)]:
+        if path is None:
             print(f"[ERRO] {tool} não encontrado no sistema")
             return
     
+    if not os.path.exists(ref_fasta):
+        print(f"[ERRO] Arquivo de referência não encontrado: {ref_fasta}")
+        return
+    
+    # Cache de referência compartilhado por todos os subprocessos
+    configure_ref_cache(ref_fasta, ref_cache)
+    
+    # Registro de receitas: reexecuções pulam amostras já feitas sem quickcheck
+    base_digest = recipe_base_digest(bed_file)
+    recipes = load_recipes(output_dir)
+    
     # Contadores
     successful = 0
     failed = 0
@@ -352,7 +577,8 @@ def main():
     with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
         # Submeter tarefas
         future_to_url = {
-            executor.submit(process_single_sample, url, bed_file, output_dir, temp_dir): url
+            executor.submit(process_single_sample, url, bed_file, output_dir, temp_dir, ref_fasta,
+                            recipes, base_digest): url
             for url in urls
         }
         
@@ -372,7 +598,7 @@ def main():
                     safe_print(f"[ERRO] {sample_id}: {message}")
                     failed += 1
             except Exception as exc:
-                sample_id = os.path.basename(url).split(".")[0] if url else "UNKNOWN"
+                sample_id = _sample_id(url) if url else "UNKNOWN"
                 safe_print(f"[ERRO] {sample_id}: Exceção: {exc}")
                 failed += 1
     
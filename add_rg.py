@@ -1,58 +1,61 @@
 #!/usr/bin/env python3
 import os
-import glob
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # Caminhos
 INPUT_DIR = "/home/lab/Desktop/arq_joao/testes_freebayes_bams_marcel/BAMs"
 OUTPUT_DIR = "/home/lab/Desktop/arq_joao/testes_freebayes_bams_marcel/BAMs_RG"
 
+# Paralelismo: BAMs simultâneos e threads de compressão por samtools
+SAMTOOLS_THREADS = 4
+MAX_WORKERS = max(1, (os.cpu_count() or SAMTOOLS_THREADS) // SAMTOOLS_THREADS)
+
 # Criar diretório de saída se não existir
 Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
 
 # Buscar todos os arquivos BAM que terminam com PIG706_sorted.bam
-bam_files = glob.glob(os.path.join(INPUT_DIR, "*.bam"))
+with os.scandir(INPUT_DIR) as entries:
+    bam_files = [entry.path for entry in entries
+                 if entry.name.endswith(".bam") and entry.is_file()]
 
-# Loop em todos os arquivos BAM
-for bam in bam_files:
+def processar_bam(bam):
+    """Adiciona read group e grava o índice na mesma passada pelo BAM."""
     filename = os.path.basename(bam)
-    
+
     # Extrair amostra do nome do arquivo (ex: HG1 → hg1)
     amostra = filename.split('-')[0].lower()
-    
+
     # Definir nome de saída
     output_bam = os.path.join(OUTPUT_DIR, filename.replace('.bam', '_rg.bam'))
-    
-    # Comando para adicionar read group
+
+    # Comando para adicionar read group (--write-index dispensa o samtools index)
     addreplacerg_cmd = [
         'samtools', 'addreplacerg',
+        '-@', str(SAMTOOLS_THREADS),
         '-r', f'ID:{amostra}',
         '-r', 'LB:lib1',
         '-r', 'PL:ONT',
         '-r', 'PU:unit1',
         '-r', f'SM:{amostra}',
-        '-o', output_bam,
+        '--write-index',
+        '-o', f"{output_bam}##idx##{output_bam}.bai",
         bam
     ]
-    
-    print(f"Processando: {filename}")
-    print(f"Amostra: {amostra}")
-    print(f"Saída: {os.path.basename(output_bam)}")
-    
+
+    print(f"Processando: {filename} (amostra: {amostra}) → {os.path.basename(output_bam)}")
+
     try:
         # Executar comando samtools addreplacerg
         subprocess.run(addreplacerg_cmd, check=True)
-        print(f"✓ Read group adicionado com sucesso")
-        
-        # Indexar o arquivo BAM
-        index_cmd = ['samtools', 'index', output_bam]
-        subprocess.run(index_cmd, check=True)
-        print(f"✓ Arquivo indexado com sucesso")
-        
+        print(f"✓ {filename}: read group adicionado e arquivo indexado")
+
     except subprocess.CalledProcessError as e:
         print(f"✗ Erro ao processar {filename}: {e}")
-    
-    print("-" * 50)
 
-print("Processamento concluído!")
\ No newline at end of file
+# Processar os BAMs em paralelo
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    list(executor.map(processar_bam, bam_files))
+
+print("Processamento concluído!")
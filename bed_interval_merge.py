@@ -6,119 +6,105 @@ Adiciona 500pb antes do start e 500pb depois do end, e junta regiões próximas
 
 import sys
 import argparse
-from typing import List, Tuple
+import numpy as np
+import pandas as pd
 
-def read_bed_file(filename: str) -> List[Tuple[str, int, int]]:
+def read_bed_file(filename: str) -> pd.DataFrame:
     """
-    Lê arquivo BED e retorna lista de tuplas (chr, start, end).
+    Lê arquivo BED e retorna DataFrame com colunas (chr, start, end).
     """
-    intervals = []
     try:
-        with open(filename, 'r') as f:
-            for line_num, line in enumerate(f, 1):
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue
-                
-                parts = line.split('\t')
-                if len(parts) < 3:
-                    print(f"Aviso: Linha {line_num} ignorada (formato inválido): {line}")
-                    continue
-                
-                try:
-                    chr_name = parts[0]
-                    start = int(parts[1])
-                    end = int(parts[2])
-                    
-                    if start >= end:
-                        print(f"Aviso: Linha {line_num} ignorada (start >= end): {line}")
-                        continue
-                    
-                    intervals.append((chr_name, start, end))
-                    
-                except ValueError:
-                    print(f"Aviso: Linha {line_num} ignorada (coordenadas inválidas): {line}")
-                    continue
-                    
+        df = pd.read_csv(filename, sep='\t', comment='#', header=None,
+                         usecols=[0, 1, 2], names=['chr', 'start', 'end'],
+                         dtype=str, skip_blank_lines=True)
     except FileNotFoundError:
         print(f"Erro: Arquivo '{filename}' não encontrado.")
         sys.exit(1)
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame({'chr': pd.Series(dtype='category'),
+                             'start': pd.Series(dtype='int64'),
+                             'end': pd.Series(dtype='int64')})
     except Exception as e:
         print(f"Erro ao ler arquivo: {e}")
         sys.exit(1)
     
-    return intervals
+    start = pd.to_numeric(df['start'], errors='coerce')
+    end = pd.to_numeric(df['end'], errors='coerce')
+    
+    invalid_coords = start.isna() | end.isna()
+    if invalid_coords.any():
+        print(f"Aviso: {int(invalid_coords.sum())} linhas ignoradas (formato ou coordenadas inválidas)")
+    
+    inverted = ~invalid_coords & (start >= end)
+    if inverted.any():
+        print(f"Aviso: {int(inverted.sum())} linhas ignoradas (start >= end)")
+    
+    valid = ~invalid_coords & ~inverted
+    return pd.DataFrame({
+        'chr': df['chr'][valid].astype('category'),
+        'start': start[valid].astype('int64'),
+        'end': end[valid].astype('int64'),
+    }).reset_index(drop=True)
 
-def expand_intervals(intervals: List[Tuple[str, int, int]], expansion: int = 500) -> List[Tuple[str, int, int]]:
+def expand_intervals(intervals: pd.DataFrame, expansion: int = 500) -> pd.DataFrame:
     """
     Expande cada intervalo adicionando 'expansion' pb antes do start e depois do end.
     """
-    expanded = []
-    for chr_name, start, end in intervals:
-        new_start = max(0, start - expansion)  # Não permite coordenadas negativas
-        new_end = end + expansion
-        expanded.append((chr_name, new_start, new_end))
+    expanded = intervals.copy()
+    expanded['start'] = np.maximum(0, intervals['start'].to_numpy() - expansion)  # Não permite coordenadas negativas
+    expanded['end'] = intervals['end'] + expansion
     
     return expanded
 
-def merge_overlapping_intervals(intervals: List[Tuple[str, int, int]], max_gap: int = 500) -> List[Tuple[str, int, int]]:
+def merge_overlapping_intervals(intervals: pd.DataFrame, max_gap: int = 500) -> pd.DataFrame:
     """
     Junta intervalos sobrepostos ou próximos (gap ≤ max_gap) no mesmo cromossomo.
     """
-    if not intervals:
-        return []
-    
-    # Agrupa por cromossomo
-    chr_groups = {}
-    for chr_name, start, end in intervals:
-        if chr_name not in chr_groups:
-            chr_groups[chr_name] = []
-        chr_groups[chr_name].append((start, end))
-    
-    merged_intervals = []
-    
-    # Processa cada cromossomo separadamente
-    for chr_name in sorted(chr_groups.keys()):
-        chr_intervals = chr_groups[chr_name]
-        
-        # Ordena por posição de início
-        chr_intervals.sort(key=lambda x: x[0])
-        
-        # Junta intervalos sobrepostos ou próximos
-        merged_chr = []
-        current_start, current_end = chr_intervals[0]
-        
-        for start, end in chr_intervals[1:]:
-            # Se o intervalo atual está próximo ou sobreposto ao anterior
-            if start <= current_end + max_gap:
-                # Estende o intervalo atual
-                current_end = max(current_end, end)
-            else:
-                # Adiciona o intervalo atual e inicia um novo
-                merged_chr.append((chr_name, current_start, current_end))
-                current_start, current_end = start, end
-        
-        # Adiciona o último intervalo
-        merged_chr.append((chr_name, current_start, current_end))
-        merged_intervals.extend(merged_chr)
-    
-    return merged_intervals
+    if intervals.empty:
+        return intervals.copy()
+    
+    # Códigos dos cromossomos em ordem alfabética e ordenação por (chr, start)
+    codes, chr_names = pd.factorize(intervals['chr'].astype(str), sort=True)
+    starts = intervals['start'].to_numpy(dtype=np.int64)
+    ends = intervals['end'].to_numpy(dtype=np.int64)
+    order = np.lexsort((starts, codes))
+    codes, starts, ends = codes[order], starts[order], ends[order]
+    
+    # Desloca cada cromossomo para uma faixa própria: assim o máximo acumulado
+    # dos ends nunca "vaza" de um cromossomo para o seguinte
+    offset = codes * (int(ends.max()) + max_gap + 1)
+    running_end = np.maximum.accumulate(ends + offset)
+    
+    # Um novo intervalo começa quando o start passa do fim acumulado + gap
+    new_group = np.empty(len(starts), dtype=bool)
+    new_group[0] = True
+    new_group[1:] = starts[1:] + offset[1:] > running_end[:-1] + max_gap
+    group_idx = np.flatnonzero(new_group)
+    
+    return pd.DataFrame({
+        'chr': pd.Categorical(chr_names[codes[group_idx]]),
+        'start': starts[group_idx],
+        'end': np.maximum.reduceat(ends, group_idx),
+    })
 
-def write_bed_file(intervals: List[Tuple[str, int, int]], filename: str):
+def write_bed_file(intervals: pd.DataFrame, filename: str):
     """
     Escreve intervalos no formato BED.
     """
     try:
+        lines = zip(intervals['chr'].astype(str).tolist(),
+                    intervals['start'].tolist(),
+                    intervals['end'].tolist())
+        buf = "".join(f"{chr_name}\t{start}\t{end}\n" for chr_name, start, end in lines)
         with open(filename, 'w') as f:
-            for chr_name, start, end in intervals:
-                f.write(f"{chr_name}\t{start}\t{end}\n")
+            f.write(buf)
         print(f"Arquivo otimizado salvo: {filename}")
     except Exception as e:
         print(f"Erro ao escrever arquivo: {e}")
         sys.exit(1)
 
-def print_statistics(original: List[Tuple[str, int, int]], 
-                    optimized: List[Tuple[str, int, int]]):
+def print_statistics(original: pd.DataFrame, 
+                    optimized: pd.DataFrame):
     """
     Imprime estatísticas da otimização.
     """
@@ -128,8 +114,8 @@ def print_statistics(original: List[Tuple[str, int, int]],
     print(f"Redução: {len(original) - len(optimized)} intervalos ({((len(original) - len(optimized)) / len(original) * 100):.1f}%)")
     
     # Calcula cobertura total
-    original_coverage = sum(end - start for _, start, end in original)
-    optimized_coverage = sum(end - start for _, start, end in optimized)
+    original_coverage = int((original['end'] - original['start']).sum())
+    optimized_coverage = int((optimized['end'] - optimized['start']).sum())
     
     print(f"Cobertura original: {original_coverage:,} pb")
     print(f"Cobertura otimizada: {optimized_coverage:,} pb")
@@ -177,7 +163,7 @@ Exemplos de uso:
     # Lê arquivo BED original
     original_intervals = read_bed_file(args.input_bed)
     
-    if not original_intervals:
+    if original_intervals.empty:
         print("Erro: Nenhum intervalo válido encontrado no arquivo.")
         sys.exit(1)
     
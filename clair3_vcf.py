@@ -8,7 +8,8 @@ gerando VCF e GVCF finais em uma pasta separada.
 import os
 import sys
 import subprocess
-import glob
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 # ================= CONFIGURAÇÕES =================
@@ -21,18 +22,47 @@ THREADS = 4
 MODEL = 'ont'#"r1041_e82_400bps_sup_v500"
 # =================================================
 
+# Núcleos realmente disponíveis (cpuset/Slurm podem não começar na CPU 0)
+if hasattr(os, "sched_getaffinity"):
+    USABLE_CPUS = sorted(os.sched_getaffinity(0))
+else:
+    USABLE_CPUS = list(range(os.cpu_count() or THREADS))
+MAX_PARALLEL_JOBS = max(1, len(USABLE_CPUS) // THREADS)  # Clair3 simultâneos
+
 def find_bam_files(bam_directory):
     """
-    Encontra todos os arquivos BAM em um diretório
+    Encontra todos os arquivos BAM em um diretório, maiores primeiro
+
+    Com vários Clair3 em paralelo, começar pelos BAMs maiores evita que
+    uma amostra grande fique sozinha rodando no fim (escalonamento LPT).
     """
-    bam_pattern = os.path.join(bam_directory, "*.bam")
-    bam_files = glob.glob(bam_pattern)
+    with os.scandir(bam_directory) as entries:
+        bam_entries = [
+            entry for entry in entries
+            if entry.name.endswith(".bam") and entry.is_file()
+        ]
+    bam_entries.sort(key=lambda entry: (-entry.stat().st_size, entry.path))
+    bam_files = [entry.path for entry in bam_entries]
     
     if not bam_files:
         print(f"Nenhum arquivo BAM encontrado em: {bam_directory}")
         sys.exit(1)
     
-    return sorted(bam_files)
+    return bam_files
+
+def init_worker(cpu_slots):
+    """
+    Fixa cada worker em um conjunto disjunto de CPUs
+
+    O Clair3 (e seus subprocessos) herdam a afinidade, evitando que vários
+    BAMs disputem os mesmos núcleos.
+    """
+    cpus = cpu_slots.get()
+    if hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError as e:
+            print(f"[AVISO] Não foi possível fixar o worker nas CPUs {sorted(cpus)}: {e}")
 
 def run_clair3(bam_file, ref_fasta, model, bed_file, output_dir, platform, threads):
     """
@@ -103,12 +133,26 @@ def main():
     bam_files = find_bam_files(BAM_DIRECTORY)
     print(f"Encontrados {len(bam_files)} BAMs")
 
-    # Executar Clair3 em cada BAM
+    # Executar Clair3 em paralelo, THREADS núcleos por BAM
+    workers = min(MAX_PARALLEL_JOBS, len(bam_files))
+    print(f"Executando {workers} Clair3 em paralelo ({THREADS} threads cada)")
+
+    cpu_slots = multiprocessing.Queue()
+    for slot in range(workers):
+        cpu_slots.put(set(USABLE_CPUS[slot * THREADS:(slot + 1) * THREADS]))
+
     vcfs = []
-    for bam_file in bam_files:
-        vcf = run_clair3(bam_file, REF_FASTA, MODEL, BED_FILE, OUTPUT_DIR, PLATFORM, THREADS)
-        if vcf:
-            vcfs.append(vcf)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(cpu_slots,)) as executor:
+        futures = [
+            executor.submit(run_clair3, bam_file, REF_FASTA, MODEL, BED_FILE,
+                            OUTPUT_DIR, PLATFORM, THREADS)
+            for bam_file in bam_files
+        ]
+        for future in as_completed(futures):
+            vcf = future.result()
+            if vcf:
+                vcfs.append(vcf)
 
     # Resumo final
     print("\n===== RESUMO =====")
@@ -1,21 +1,133 @@
 import os
 import subprocess
 import concurrent.futures
-from threading import Lock
+from threading import Lock, Condition, Thread, Event
+from collections import deque
+from contextlib import contextmanager
 import time
 import random
+import signal
+import statistics
+import json
+import re
+import sys
+import queue
+import logging
+import logging.handlers
+from dataclasses import dataclass
+import hashlib
+import shutil
+import urllib.request
+from itertools import zip_longest
+from urllib.parse import urlsplit
 
-# Lock para sincronizar prints
-print_lock = Lock()
+# Mensagens das threads vão para uma fila; uma única thread (QueueListener)
+# escreve no terminal e, opcionalmente, num log JSON-lines em output_dir
+JSON_LOG_FILE = "cram_bam_paralel.log.jsonl"
+log_queue = queue.SimpleQueue()
+logger = logging.getLogger("cram_bam_paralel")
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.propagate = False
 
-def safe_print(*args, **kwargs):
-    """Print thread-safe"""
-    with print_lock:
-        print(*args, **kwargs)
+# Limite por servidor: (conexões simultâneas, intervalo mínimo entre novas
+# conexões em segundos). As threads só ocupam uma vaga durante o samtools:
+# amostras esperando retry não bloqueiam. O limite cai pela metade quando o
+# servidor começa a recusar conexões (429/connection reset repetidos)
+HOST_LIMITS = {
+    "1KG_EBI": (4, 0.5),
+    "SRA_EBI": (2, 2.0),
+    "UNKNOWN": (2, 2.0),
+}
+THROTTLE_STRIKES = 2  # Recusas seguidas antes de reduzir o limite
+host_cond = Condition()
+host_limit = {source: limit for source, (limit, _) in HOST_LIMITS.items()}
+host_active = {source: 0 for source in HOST_LIMITS}
+host_last = {source: 0.0 for source in HOST_LIMITS}
+host_strikes = {source: 0 for source in HOST_LIMITS}
+
+# Assinaturas BGZF verificadas pelo samtools quickcheck
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# Threads de (des)compressão por samtools e nível zlib do BAM de saída:
+# nível 1 comprime bem mais rápido e o recorte é pequeno
+SAMTOOLS_THREADS = 4
+BAM_COMPRESSION_LEVEL = 1
+
+# Watchdog de amostras lentas: na reta final (menos de STRAGGLER_TAIL das
+# amostras pendentes), um samtools rodando há mais de STRAGGLER_FACTOR vezes
+# a mediana das amostras concluídas é interrompido e reiniciado na hora, sem
+# gastar tentativa (até STRAGGLER_LIMIT vezes por amostra; a última tentativa
+# nunca é interrompida)
+STRAGGLER_FACTOR = 2.0
+STRAGGLER_TAIL = 0.10
+STRAGGLER_LIMIT = 3
+WATCHDOG_INTERVAL = 30
+fetch_lock = Lock()
+active_fetches = {}     # (temp_bam, última tentativa) -> (Popen, início)
+fetch_durations = []    # duração das tentativas bem-sucedidas
+straggler_kills = {}    # temp_bam -> vezes interrompida pelo watchdog
+straggled = set()       # tentativas interrompidas ainda não tratadas
+shutting_down = Event() # Ctrl-C/SIGTERM: não iniciar novos samtools nem retries
+
+# Cache local dos índices CRAI remotos (reaproveitados entre tentativas)
+CRAI_CACHE_DIR = ".crai_cache"
+CRAI_TIMEOUT = 30  # segundos por URL
+
+# BED do painel ordenado/unido, gerado uma vez em output_dir
+MERGED_BED_FILE = ".panel.merged.bed"
+
+# Registro persistente das amostras concluídas, gravado em output_dir
+REGISTRY_FILE = ".registry.json"
+registry_lock = Lock()
+
+class JsonLinesFormatter(logging.Formatter):
+    """Uma linha JSON por mensagem: horário, thread, tag ([INFO], [ERRO]...) e texto"""
+    
+    TAG_RE = re.compile(r"^\[(\w+)\]")
+    
+    def format(self, record):
+        message = record.getMessage()
+        tag = self.TAG_RE.match(message)
+        return json.dumps({
+            "time": self.formatTime(record),
+            "thread": record.threadName,
+            "tag": tag.group(1) if tag else None,
+            "message": message,
+        }, ensure_ascii=False)
+
+def start_logging(json_log=None):
+    """
+    Inicia a thread que consome a fila de log
+    
+    Args:
+        json_log: Caminho do log JSON-lines (None para só o terminal)
+    
+    Returns:
+        QueueListener: chamar .stop() ao final para esvaziar a fila
+    """
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter("%(message)s"))
+    handlers = [console]
+    if json_log:
+        json_handler = logging.FileHandler(json_log, encoding="utf-8")
+        json_handler.setFormatter(JsonLinesFormatter())
+        handlers.append(json_handler)
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    return listener
+
+def safe_print(*args):
+    """Print thread-safe: enfileira a mensagem para a thread de log"""
+    logger.info(" ".join(map(str, args)))
 
 def validate_bam_file(bam_path):
     """
-    Valida se o arquivo BAM está íntegro usando samtools quickcheck
+    Valida se o arquivo BAM está íntegro, sem abrir um subprocesso
+    
+    Faz a mesma verificação do samtools quickcheck (bgzf_check_EOF do
+    htslib): magic BGZF no início e bloco EOF de 28 bytes no final.
     
     Args:
         bam_path: Caminho para o arquivo BAM
@@ -23,28 +135,86 @@ def validate_bam_file(bam_path):
     Returns:
         bool: True se o arquivo está íntegro, False caso contrário
     """
-    if not os.path.exists(bam_path):
+    try:
+        with open(bam_path, "rb") as f:
+            if f.read(4) != BGZF_MAGIC:
+                return False
+            f.seek(0, os.SEEK_END)
+            if f.tell() < 1024:  # Menos de 1KB provavelmente está corrompido
+                return False
+            f.seek(-len(BGZF_EOF), os.SEEK_END)
+            return f.read(len(BGZF_EOF)) == BGZF_EOF
+    except OSError:
         return False
+
+def durable_replace(tmp_path, final_path):
+    """
+    Substitui final_path por tmp_path de forma atômica e durável
     
-    # Verificar se o arquivo tem tamanho mínimo razoável
+    Faz fsync do conteúdo antes do rename e do diretório depois dele: após
+    uma queda de energia o destino é o arquivo antigo ou o novo completo,
+    nunca um arquivo vazio com o nome final.
+    """
+    with open(tmp_path, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, final_path)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(final_path)), os.O_DIRECTORY)
     try:
-        file_size = os.path.getsize(bam_path)
-        if file_size < 1024:  # Menos de 1KB provavelmente está corrompido
-            return False
-    except:
-        return False
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def file_sha256(path):
+    """
+    Calcula o SHA-256 do arquivo lendo do disco, não do page cache
     
+    O posix_fadvise(DONTNEED) descarta as páginas em cache antes da leitura,
+    para que o hash reflita o que de fato está gravado.
+    """
+    with open(path, "rb") as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+def load_registry(output_dir):
+    """
+    Carrega o registro de amostras concluídas
+    
+    Returns:
+        dict: sample_id -> {"status", "size", "mtime", "sha256", "url"}
+    """
     try:
-        # samtools quickcheck retorna 0 se o arquivo está OK
-        result = subprocess.run(
-            ["samtools", "quickcheck", bam_path],
-            capture_output=True,
-            check=False,
-            timeout=30  # Timeout para validação
-        )
-        return result.returncode == 0
-    except Exception:
+        with open(os.path.join(output_dir, REGISTRY_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def registry_matches(registry, sample_id, bam_path):
+    """Verifica, com um único stat, se o BAM registrado não mudou desde então"""
+    entry = registry.get(sample_id)
+    if not entry or entry.get("status") != "ok":
         return False
+    try:
+        st = os.stat(bam_path)
+    except FileNotFoundError:
+        return False
+    return st.st_size == entry["size"] and st.st_mtime == entry["mtime"]
+
+def update_registry(registry, output_dir, sample_id, bam_path, url=None, digest=None):
+    """Registra uma amostra concluída (com o SHA-256 do BAM) e regrava o registro de forma atômica"""
+    st = os.stat(bam_path)
+    if digest is None:
+        digest = file_sha256(bam_path)
+    registry_path = os.path.join(output_dir, REGISTRY_FILE)
+    with registry_lock:
+        entry = {"status": "ok", "size": st.st_size, "mtime": st.st_mtime, "sha256": digest}
+        if url:
+            entry["url"] = canonical_url(url)
+        registry[sample_id] = entry
+        tmp_path = registry_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(registry, f, indent=1)
+        durable_replace(tmp_path, registry_path)
 
 def remove_corrupted_file(file_path):
     """Remove arquivo corrompido de forma segura"""
@@ -97,49 +267,432 @@ def convert_ftp_to_https(url):
     
     return alternatives
 
-def process_sample_with_retry(url, bed_file, output_dir, max_retries=3):
+def configure_ref_cache(ref_fasta, ref_cache):
+    """
+    Prepara o cache local de referência (REF_CACHE/REF_PATH) do htslib
+    
+    Sem isso, cada samtools sobre um CRAM remoto busca as sequências de
+    referência por MD5 no servidor da EBI. O cache é populado uma única vez a
+    partir do FASTA local e as variáveis de ambiente são herdadas pelos
+    subprocessos de todas as threads.
+    
+    Args:
+        ref_fasta: FASTA de referência (GRCh38)
+        ref_cache: Diretório raiz do cache
+    """
+    os.makedirs(ref_cache, exist_ok=True)
+    
+    if not os.listdir(ref_cache):
+        populate = shutil.which("seq_cache_populate.pl")
+        if populate and os.path.exists(ref_fasta):
+            print(f"[INFO] Populando cache de referência em {ref_cache} (apenas na primeira execução)...")
+            try:
+                subprocess.run([populate, "-root", ref_cache, ref_fasta],
+                               check=True, capture_output=True, text=True, timeout=7200)
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                print(f"[AVISO] Falha ao popular cache de referência: {e}")
+        else:
+            print("[AVISO] seq_cache_populate.pl ou FASTA não encontrado; cache será preenchido sob demanda")
+    
+    cache_pattern = os.path.join(ref_cache, "%2s", "%2s", "%s")
+    os.environ["REF_CACHE"] = cache_pattern
+    # Local primeiro, servidor da EBI apenas como último recurso
+    os.environ["REF_PATH"] = f"{cache_pattern}:https://www.ebi.ac.uk/ena/cram/md5/%s"
+
+def fetch_crai(url, cache_dir, source, timeout=CRAI_TIMEOUT):
+    """
+    Baixa o índice CRAI da amostra uma única vez para um cache local
+    
+    Com o índice local (samtools view -X), cada tentativa e cada protocolo
+    alternativo reaproveitam o mesmo CRAI em vez de buscá-lo de novo. O
+    download ocupa uma vaga do servidor como o samtools; o CRAI é pequeno,
+    então o timeout é curto e, se falhar, fica o índice remoto.
+    
+    Args:
+        url: URL original do arquivo CRAM
+        cache_dir: Diretório do cache de índices
+        source: Origem dos dados, usada para o limite por servidor
+        timeout: Timeout em segundos por URL
+    
+    Returns:
+        str: Caminho do CRAI local, ou None se não foi possível baixá-lo
+    """
+    crai_path = os.path.join(cache_dir, hashlib.sha1(url.encode()).hexdigest() + ".crai")
+    try:
+        if os.path.getsize(crai_path) > 0:
+            return crai_path
+    except OSError:
+        pass
+    
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = crai_path + ".tmp"
+    for candidate in convert_ftp_to_https(url):
+        if shutting_down.is_set():
+            break
+        try:
+            with host_slot(source), \
+                 urllib.request.urlopen(candidate + ".crai", timeout=timeout) as response, \
+                 open(tmp_path, "wb") as out:
+                shutil.copyfileobj(response, out)
+            if os.path.getsize(tmp_path) > 0:
+                os.replace(tmp_path, crai_path)
+                return crai_path
+        except Exception:
+            pass
+    
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
+    return None
+
+class NetworkError(Exception):
+    """Falha transitória de rede/conexão: vale a pena tentar de novo"""
+
+class ServerError(Exception):
+    """Arquivo inexistente ou acesso negado: não adianta repetir a mesma URL"""
+
+class ProtocolError(Exception):
+    """Protocolo/SSL não suportado: passar para a próxima URL alternativa"""
+
+class StragglerRestart(Exception):
+    """Tentativa lenta interrompida pelo watchdog: repetir já, sem contar tentativa"""
+
+# Política de retry: padrões do stderr do samtools -> classe de erro
+# (uma regex compilada por classe, uma única passada sobre a mensagem)
+NETWORK_RE = re.compile(
+    r"connection reset|connection refused|timeout|network|failed to open|eof marker|"
+    r"truncated|seek at offset|container header crc32 failure|retrieval of region|error closing")
+SERVER_RE = re.compile(r"no such file|404|not found|access denied|permission")
+PROTOCOL_RE = re.compile(r"protocol not supported|unsupported protocol|ssl|certificate")
+
+# Teto do backoff entre tentativas (segundos)
+MAX_BACKOFF = 600
+
+@contextmanager
+def host_slot(source):
+    """
+    Ocupa uma vaga de conexão no servidor, respeitando o intervalo mínimo
+    
+    Args:
+        source: Origem dos dados (ver get_data_source)
+    """
+    interval = HOST_LIMITS[source][1]
+    with host_cond:
+        while True:
+            if host_active[source] < host_limit[source]:
+                wait = host_last[source] + interval - time.monotonic()
+                if wait <= 0:
+                    break
+                host_cond.wait(wait)
+            else:
+                host_cond.wait()
+        host_active[source] += 1
+        host_last[source] = time.monotonic()
+    try:
+        yield
+    finally:
+        with host_cond:
+            host_active[source] -= 1
+            host_cond.notify_all()
+
+def report_host_result(source, refused):
+    """
+    Ajusta o limite do servidor conforme o resultado da última conexão
+    
+    Recusas seguidas (429/connection reset) reduzem o limite pela metade;
+    um sucesso zera a contagem.
+    """
+    with host_cond:
+        if not refused:
+            host_strikes[source] = 0
+            return
+        host_strikes[source] += 1
+        if host_strikes[source] >= THROTTLE_STRIKES and host_limit[source] > 1:
+            host_limit[source] //= 2
+            host_strikes[source] = 0
+            safe_print(f"[AVISO] {source}: servidor recusando conexões, limite reduzido para {host_limit[source]}")
+
+def classify_error(error_msg):
+    """
+    Converte a mensagem de erro do samtools na exceção da política de retry
+    
+    Args:
+        error_msg: stderr do samtools
+    
+    Returns:
+        Exception: ServerError, ProtocolError, NetworkError ou Exception genérica
+    """
+    error_lower = error_msg.lower()
+    if SERVER_RE.search(error_lower):
+        return ServerError(error_msg)
+    if PROTOCOL_RE.search(error_lower):
+        return ProtocolError(error_msg)
+    if NETWORK_RE.search(error_lower):
+        return NetworkError(error_msg)
+    return Exception(error_msg)
+
+def backoff_delay(attempt, base_delay, max_delay=MAX_BACKOFF):
+    """
+    Backoff exponencial com jitter completo
+    
+    Sorteia o atraso em [0, min(max_delay, base_delay * 2^attempt)] para que
+    amostras que falharam juntas não voltem ao servidor no mesmo instante.
+    """
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+def _run_bounded(cmd, timeout, stderr_tail=8192, key=None):
+    """
+    Executa um comando guardando apenas o final do stderr
+    
+    Diferente de capture_output=True, o stderr é drenado por uma thread para
+    um buffer circular de stderr_tail bytes: a memória por worker fica
+    limitada mesmo em execuções longas e muito verbosas. O processo roda em
+    sessão própria para que kill alcance também seus descendentes.
+    
+    Args:
+        cmd: Comando a executar
+        timeout: Timeout em segundos (o processo é morto ao estourar)
+        stderr_tail: Quantidade máxima de bytes de stderr mantida
+        key: Se informado, registra o processo para o watchdog de amostras
+            lentas: (temp_bam, True se for a última tentativa da amostra)
+    
+    Returns:
+        tuple: (returncode, final do stderr)
+    
+    Raises:
+        subprocess.TimeoutExpired
+    """
+    tail = deque(maxlen=stderr_tail)
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                               start_new_session=True)
+    with fetch_lock:
+        if key:
+            active_fetches[key] = (process, time.monotonic())
+        stopping = shutting_down.is_set()
+    if stopping:
+        # Iniciado depois de stop_all_fetches: não deixa o samtools seguir
+        kill_process_group(process)
+    
+    def drain():
+        for chunk in iter(lambda: process.stderr.read(4096), b""):
+            tail.extend(chunk)
+    
+    reader = Thread(target=drain, daemon=True)
+    reader.start()
+    try:
+        returncode = process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_process_group(process)
+        process.wait()
+        raise
+    finally:
+        if key:
+            with fetch_lock:
+                active_fetches.pop(key, None)
+        reader.join()
+        process.stderr.close()
+    return returncode, bytes(tail).decode(errors="replace")
+
+def kill_process_group(process):
+    """Mata o processo e seus descendentes (sessão criada em _run_bounded)"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def stop_all_fetches():
+    """
+    Interrompe todos os samtools em andamento (Ctrl-C/SIGTERM)
+    
+    Como cada samtools roda em sessão própria, o SIGINT do terminal não
+    chega até ele: os grupos de processo são mortos aqui. Com shutting_down
+    sinalizado, as threads também não começam novas tentativas.
+    """
+    with fetch_lock:
+        shutting_down.set()
+        processes = [process for process, _ in active_fetches.values()]
+    for process in processes:
+        kill_process_group(process)
+
+def raise_keyboard_interrupt(signum, frame):
+    """Trata SIGTERM como Ctrl-C no thread principal"""
+    raise KeyboardInterrupt
+
+def straggler_watchdog(stop, total, remaining):
+    """
+    Interrompe tentativas muito mais lentas que a mediana na reta final
+    
+    Roda em thread própria até stop ser sinalizado. A amostra interrompida
+    recebe StragglerRestart em run_fetch e é repetida na hora, numa conexão
+    nova, sem gastar tentativa nem esperar backoff. A última tentativa de
+    cada amostra fica de fora: ela tem o timeout inteiro, como antes.
+    
+    Args:
+        stop: Event que encerra o watchdog
+        total: Número total de amostras
+        remaining: Função que retorna quantas amostras ainda não terminaram
+    """
+    while not stop.wait(WATCHDOG_INTERVAL):
+        if remaining() > total * STRAGGLER_TAIL:
+            continue
+        with fetch_lock:
+            if not fetch_durations:
+                continue
+            limit = STRAGGLER_FACTOR * statistics.median(fetch_durations)
+            now = time.monotonic()
+            for (key, last_attempt), (process, started) in active_fetches.items():
+                if (last_attempt or now - started <= limit
+                        or straggler_kills.get(key, 0) >= STRAGGLER_LIMIT):
+                    continue
+                straggler_kills[key] = straggler_kills.get(key, 0) + 1
+                straggled.add(key)
+                safe_print(f"[AVISO] {os.path.basename(key)}: {now - started:.0f}s (> {limit:.0f}s), "
+                           f"reiniciando tentativa ({straggler_kills[key]}/{STRAGGLER_LIMIT})")
+                kill_process_group(process)
+
+def run_fetch(cmd, timeout, temp_bam, source, last_attempt=False):
+    """
+    Executa uma tentativa do samtools e classifica a falha
+    
+    Ocupa uma vaga de conexão apenas enquanto o samtools roda; o tempo de
+    espera entre tentativas fica fora do semáforo.
+    
+    Args:
+        cmd: Comando samtools view
+        timeout: Timeout da tentativa em segundos
+        temp_bam: Arquivo temporário gerado pelo comando
+        source: Origem dos dados, usada para o limite por servidor
+        last_attempt: Última tentativa da amostra (o watchdog não a interrompe)
+    
+    Returns:
+        float: Tempo gasto na tentativa
+    
+    Raises:
+        StragglerRestart, NetworkError, ServerError, ProtocolError ou Exception
+    """
+    try:
+        with host_slot(source):
+            start_time = time.time()
+            returncode, stderr = _run_bounded(cmd, timeout, key=(temp_bam, last_attempt))
+            elapsed = time.time() - start_time
+    except subprocess.TimeoutExpired:
+        remove_corrupted_file(temp_bam)
+        raise NetworkError(f"Timeout de {timeout}s")
+    
+    with fetch_lock:
+        was_straggler = temp_bam in straggled
+        straggled.discard(temp_bam)
+    if was_straggler:
+        remove_corrupted_file(temp_bam)
+        raise StragglerRestart("Tentativa lenta interrompida pelo watchdog")
+    
+    if returncode != 0:
+        remove_corrupted_file(temp_bam)
+        error_msg = stderr.strip() or f"samtools saiu com código {returncode}"
+        error_lower = error_msg.lower()
+        report_host_result(source, "429" in error_lower or "connection reset" in error_lower)
+        raise classify_error(error_msg)
+    
+    report_host_result(source, False)
+    
+    if not validate_bam_file(temp_bam):
+        remove_corrupted_file(temp_bam)
+        # Arquivo truncado costuma ser conexão interrompida no meio
+        raise NetworkError("Arquivo gerado está corrompido")
+    
+    with fetch_lock:
+        fetch_durations.append(elapsed)
+    return elapsed
+
+@dataclass(slots=True)
+class Job:
+    """Amostra a processar, com a URL interpretada uma única vez em main()"""
+    url: str
+    url_alternatives: list
+    sample_id: str
+    source: str
+    output_bam: str
+    timeout: int
+    base_delay: int
+
+def make_job(url, output_dir):
+    """
+    Monta o Job de uma URL: nome da amostra, origem, URLs alternativas e
+    timeouts por fonte
+    
+    Args:
+        url: URL do arquivo CRAM (já sem espaços)
+        output_dir: Diretório de saída
+    
+    Returns:
+        Job
+    """
+    sample_id = os.path.basename(url).split(".")[0]
+    source = get_data_source(url)
+    
+    # Configurar timeouts baseado na fonte
+    if source == "SRA_EBI":
+        timeout, base_delay = 3600, 60  # 1 hora para SRA (mais lento)
+    else:
+        timeout, base_delay = 1800, 30  # 30 min para 1KG
+    
+    return Job(
+        url=url,
+        url_alternatives=convert_ftp_to_https(url),  # HTTPS primeiro, depois FTP
+        sample_id=sample_id,
+        source=source,
+        output_bam=os.path.join(output_dir, f"{sample_id}.bam"),
+        timeout=timeout,
+        base_delay=base_delay,
+    )
+
+def process_sample_with_retry(job, bed_file, output_dir, max_retries=3, registry=None):
     """
     Processa uma única amostra com sistema de retry, tentando HTTPS primeiro
     
     Args:
-        url: URL do arquivo CRAM
+        job: Amostra a processar (ver make_job)
         bed_file: Caminho para o arquivo .bed
         output_dir: Diretório de saída
         max_retries: Número máximo de tentativas
+        registry: Registro de amostras concluídas (ver load_registry)
     
     Returns:
         tuple: (success, sample_id, message)
     """
-    if not url.strip():
-        return False, "", "URL vazia"
+    sample_id = job.sample_id
+    output_bam = job.output_bam
+    data_source = job.source
+    timeout_per_attempt = job.timeout
+    base_delay = job.base_delay
+    
+    if registry is None:
+        registry = {}
     
-    # Extrair o nome da amostra
-    filename = os.path.basename(url.strip())
-    sample_id = filename.split(".")[0]
-    output_bam = os.path.join(output_dir, f"{sample_id}.bam")
-    data_source = get_data_source(url)
+    # Registro diz que está pronto e o arquivo não mudou: nem valida de novo
+    if registry_matches(registry, sample_id, output_bam):
+        return True, sample_id, f"Arquivo já existe (registro): {output_bam}"
     
     # Verificar se arquivo já existe e está íntegro
     if os.path.exists(output_bam):
-        if validate_bam_file(output_bam):
+        # O BGZF EOF não enxerga corrupção no meio do arquivo: se o registro
+        # tem o hash do BAM, ele também precisa bater
+        known_digest = registry.get(sample_id, {}).get("sha256")
+        digest = file_sha256(output_bam) if known_digest else None
+        if validate_bam_file(output_bam) and digest == known_digest:
+            update_registry(registry, output_dir, sample_id, output_bam, job.url, digest)
             return True, sample_id, f"Arquivo válido já existe: {output_bam}"
         else:
             safe_print(f"[AVISO] {sample_id}: Arquivo existe mas está corrompido, removendo...")
             remove_corrupted_file(output_bam)
     
-    # Configurar timeouts baseado na fonte
-    if data_source == "SRA_EBI":
-        timeout_per_attempt = 3600  # 1 hora para SRA (mais lento)
-        base_delay = 60
-    else:
-        timeout_per_attempt = 1800  # 30 min para 1KG
-        base_delay = 30
-    
-    # Obter URLs alternativas (HTTPS primeiro, depois FTP)
-    url_alternatives = convert_ftp_to_https(url)
+    # Índice local compartilhado por todas as tentativas; se não der para
+    # baixá-lo, o htslib busca o .crai remoto a cada tentativa como antes
+    crai_path = fetch_crai(job.url, os.path.join(output_dir, CRAI_CACHE_DIR), job.source)
     
     # Tentar cada URL alternativa
-    for url_idx, current_url in enumerate(url_alternatives):
+    for url_idx, current_url in enumerate(job.url_alternatives):
         protocol = "HTTPS" if current_url.startswith("https://") else "FTP"
         
         # Se for a segunda tentativa (FTP), só tentar se HTTPS falhou por erro de protocolo
@@ -148,6 +701,8 @@ def process_sample_with_retry(url, bed_file, output_dir, max_retries=3):
         
         # Tentar download com retry para esta URL
         for attempt in range(max_retries):
+            if shutting_down.is_set():
+                return False, sample_id, "Interrompido"
             temp_bam = output_bam + ".tmp"
             try:
                 safe_print(f"[INFO] {sample_id} ({data_source}/{protocol}): Tentativa {attempt + 1}/{max_retries}")
@@ -155,97 +710,189 @@ def process_sample_with_retry(url, bed_file, output_dir, max_retries=3):
                 # Montar o comando samtools com configurações otimizadas
                 cmd = [
                     "samtools", "view",
+                    "-@", str(SAMTOOLS_THREADS),
+                    "--output-fmt-option", f"level={BAM_COMPRESSION_LEVEL}",
                     "-b", "-ML", bed_file,
                     "-o", temp_bam,  # Usar arquivo temporário primeiro
-                    current_url.strip()
                 ]
-                
-                # Executar comando
-                start_time = time.time()
-                result = subprocess.run(
-                    cmd, 
-                    check=True, 
-                    capture_output=True, 
-                    text=True,
-                    timeout=timeout_per_attempt
-                )
-                elapsed = time.time() - start_time
-                
-                # Validar arquivo temporário
-                if validate_bam_file(temp_bam):
-                    # Mover arquivo temporário para destino final
-                    os.rename(temp_bam, output_bam)
-                    
-                    return True, sample_id, f"Concluído via {protocol} em {elapsed:.2f}s (tentativa {attempt + 1}) - {output_bam}"
+                if crai_path:
+                    cmd += ["-X", current_url, crai_path]
                 else:
-                    safe_print(f"[AVISO] {sample_id}: Arquivo gerado está corrompido (tentativa {attempt + 1})")
-                    remove_corrupted_file(temp_bam)
-                    raise Exception("Arquivo gerado está corrompido")
-                    
-            except subprocess.TimeoutExpired:
-                safe_print(f"[AVISO] {sample_id}: Timeout de {timeout_per_attempt}s na tentativa {attempt + 1}")
-                remove_corrupted_file(temp_bam)
-                if attempt < max_retries - 1:
-                    delay = min(base_delay * (2 ** attempt) + random.uniform(0, 10), 300)
-                    safe_print(f"[INFO] {sample_id}: Aguardando {delay:.1f}s antes da próxima tentativa...")
-                    time.sleep(delay)
+                    cmd.append(current_url)
                 
-            except subprocess.CalledProcessError as e:
-                error_msg = e.stderr if e.stderr else str(e)
-                safe_print(f"[AVISO] {sample_id}: Erro samtools ({protocol}) na tentativa {attempt + 1}: {error_msg.strip()}")
-                remove_corrupted_file(temp_bam)
-                
-                # Analisar tipo de erro
-                error_lower = error_msg.lower()
-                is_network_error = any(keyword in error_lower for keyword in 
-                       ['connection reset', 'connection refused', 'timeout', 'network', 
-                        'failed to open', 'eof marker', 'truncated', 'seek at offset',
-                        'container header crc32 failure', 'retrieval of region', 'error closing'])
+                # Interrupção do watchdog não conta como tentativa: repete na
+                # hora (limitado a STRAGGLER_LIMIT pelo próprio watchdog)
+                while True:
+                    try:
+                        elapsed = run_fetch(cmd, timeout_per_attempt, temp_bam, data_source,
+                                            last_attempt=attempt == max_retries - 1)
+                        break
+                    except StragglerRestart as e:
+                        if shutting_down.is_set():
+                            return False, sample_id, "Interrompido"
+                        safe_print(f"[INFO] {sample_id}: {e}, reiniciando ({protocol}, tentativa {attempt + 1})")
                 
-                is_server_error = any(keyword in error_lower for keyword in 
-                       ['no such file', '404', 'not found', 'access denied', 'permission'])
+                # Mover arquivo temporário (já validado) para o destino final
+                durable_replace(temp_bam, output_bam)
+                update_registry(registry, output_dir, sample_id, output_bam, job.url)
+                if crai_path:
+                    try:
+                        os.remove(crai_path)
+                    except OSError:
+                        pass
                 
-                is_protocol_error = any(keyword in error_lower for keyword in 
-                       ['protocol not supported', 'unsupported protocol', 'ssl', 'certificate'])
+                return True, sample_id, f"Concluído via {protocol} em {elapsed:.2f}s (tentativa {attempt + 1}) - {output_bam}"
                 
-                if is_server_error:
-                    # Para erros de servidor, não vale a pena tentar novamente esta URL
-                    safe_print(f"[INFO] {sample_id}: Erro de servidor com {protocol}, tentando próxima URL se disponível")
-                    break
-                
-                elif is_protocol_error and protocol == "HTTPS":
+            except ServerError as e:
+                # Para erros de servidor, não vale a pena tentar novamente esta URL
+                safe_print(f"[AVISO] {sample_id}: Erro samtools ({protocol}) na tentativa {attempt + 1}: {e}")
+                safe_print(f"[INFO] {sample_id}: Erro de servidor com {protocol}, tentando próxima URL se disponível")
+                break
+            
+            except ProtocolError as e:
+                safe_print(f"[AVISO] {sample_id}: Erro samtools ({protocol}) na tentativa {attempt + 1}: {e}")
+                if protocol == "HTTPS":
                     # Se HTTPS falhou por problema de protocolo, pular para FTP
                     safe_print(f"[INFO] {sample_id}: Erro de protocolo HTTPS, pulando para FTP")
-                    break
-                
-                elif is_network_error and attempt < max_retries - 1:
-                    # Para erros de rede, aguardar mais tempo
-                    delay = min(base_delay * (2 ** attempt) + random.uniform(0, 10), 600)  # Max 10 min
+                break
+            
+            except NetworkError as e:
+                safe_print(f"[AVISO] {sample_id}: {e} ({protocol}, tentativa {attempt + 1})")
+                if attempt < max_retries - 1:
+                    delay = backoff_delay(attempt, base_delay)
                     safe_print(f"[INFO] {sample_id}: Erro de rede/conectividade, aguardando {delay:.1f}s...")
-                    time.sleep(delay)
-                elif not is_network_error:
-                    # Para outros tipos de erro, falhar rapidamente nesta URL
-                    break
-                    
+                    shutting_down.wait(delay)  # acorda na hora se o usuário interromper
+            
             except Exception as e:
                 safe_print(f"[AVISO] {sample_id}: Erro geral na tentativa {attempt + 1}: {str(e)}")
                 remove_corrupted_file(temp_bam)
-                if attempt < max_retries - 1:
-                    delay = min(20 * (2 ** attempt) + random.uniform(0, 5), 120)
-                    safe_print(f"[INFO] {sample_id}: Aguardando {delay:.1f}s antes da próxima tentativa...")
-                    time.sleep(delay)
+                # Para outros tipos de erro, falhar rapidamente nesta URL
+                break
     
     # Se chegou aqui, todas as URLs e tentativas falharam
     return False, sample_id, f"Falhou com HTTPS e FTP após {max_retries} tentativas cada"
 
+def prepare_merged_bed(bed_file, output_dir):
+    """
+    Ordena e une os intervalos do BED uma única vez para todas as amostras
+    
+    Cada samtools view -ML monta a árvore de regiões a partir do BED; com os
+    intervalos já ordenados e sem sobreposição, a árvore é menor e o
+    trabalho não se repete em cada processo. Os reads selecionados são os
+    mesmos.
+    
+    Args:
+        bed_file: BED original do painel
+        output_dir: Diretório onde o BED unido é gravado
+    
+    Returns:
+        str: Caminho do BED unido (ou o original se não der para processá-lo)
+    """
+    intervals = {}
+    try:
+        with open(bed_file) as f:
+            for line in f:
+                if not line.strip() or line.startswith(("#", "track", "browser")):
+                    continue
+                fields = line.split("\t")
+                intervals.setdefault(fields[0], []).append((int(fields[1]), int(fields[2])))
+    except (OSError, IndexError, ValueError) as e:
+        print(f"[AVISO] Não foi possível pré-processar o BED ({e}); usando o original")
+        return bed_file
+    
+    merged_path = os.path.join(output_dir, MERGED_BED_FILE)
+    total = 0
+    tmp_path = merged_path + ".tmp"
+    with open(tmp_path, "w") as out:
+        for chrom, regions in intervals.items():
+            regions.sort()
+            cur_start, cur_end = regions[0]
+            for start, end in regions[1:]:
+                if start <= cur_end:
+                    cur_end = max(cur_end, end)
+                else:
+                    out.write(f"{chrom}\t{cur_start}\t{cur_end}\n")
+                    total += 1
+                    cur_start, cur_end = start, end
+            out.write(f"{chrom}\t{cur_start}\t{cur_end}\n")
+            total += 1
+    os.replace(tmp_path, merged_path)
+    
+    original = sum(len(regions) for regions in intervals.values())
+    print(f"[INFO] BED do painel: {original} intervalos -> {total} após ordenar/unir ({merged_path})")
+    return merged_path
+
+def canonical_url(url):
+    """Chave de comparação da URL: host em minúsculas + caminho, ignorando o protocolo"""
+    parts = urlsplit(url.strip())
+    return parts.netloc.lower(), parts.path
+
+def deduplicate_jobs(jobs, registry):
+    """
+    Remove URLs repetidas e detecta amostras diferentes com o mesmo nome
+    
+    A mesma URL (inclusive a variante FTP/HTTPS) é processada uma vez só.
+    URLs diferentes que resultariam no mesmo <sample_id>.bam sobrescreveriam
+    uma à outra: mantém a primeira e avisa sobre as demais. O registro de
+    execuções anteriores também é consultado, para que um BAM já concluído
+    a partir de outra URL não seja substituído.
+    
+    Args:
+        jobs: Lista de Job na ordem do arquivo
+        registry: Registro de amostras concluídas (ver load_registry)
+    
+    Returns:
+        list: Jobs únicos
+    """
+    seen = set()
+    sample_to_url = {sample_id: tuple(entry["url"]) for sample_id, entry in registry.items()
+                     if entry.get("url")}
+    unique = []
+    duplicates = 0
+    for job in jobs:
+        key = canonical_url(job.url)
+        if key in seen:
+            duplicates += 1
+            continue
+        seen.add(key)
+        previous = sample_to_url.setdefault(job.sample_id, key)
+        if previous != key:
+            print(f"[AVISO] {job.sample_id}: colisão de nome entre {job.url} e {previous[0]}{previous[1]}; ignorando a segunda")
+            continue
+        unique.append(job)
+    
+    if duplicates:
+        print(f"[INFO] {duplicates} URLs duplicadas ignoradas")
+    return unique
+
+def interleave_by_source(jobs):
+    """
+    Intercala as amostras por servidor (round-robin)
+    
+    Evita rajadas de amostras do mesmo servidor enquanto o outro fica ocioso:
+    cada servidor sempre tem trabalho na fila para ocupar suas vagas.
+    
+    Args:
+        jobs: Lista de Job na ordem do arquivo
+    
+    Returns:
+        list: Jobs intercalados, preservando a ordem relativa de cada servidor
+    """
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job.source, []).append(job)
+    return [job for batch in zip_longest(*groups.values()) for job in batch if job]
+
 def main():
     # Configurações #nay
     bed_file = "/home/lab/Desktop/arq_joao/ANCESTRY_PANEL/reference_panel.bed"
     output_dir = "/home/lab/Desktop/arq_joao/ANCESTRY_PANEL/BAMs"
     links_file = "/home/lab/Desktop/arq_joao/ANCESTRY_PANEL/1kg_hgdp_cram.txt"
+    ref_fasta = "/home/lab/Desktop/arq_joao/NativoAmericanas/reference/GRCh38_full_analysis_set_plus_decoy_hla.fa"
+    ref_cache = os.path.expanduser("~/.cache/hts-ref")
     
     # Configurações de processamento (reduzidas para ser mais gentil)
-    MAX_WORKERS = 2  # Reduzido ainda mais para evitar sobrecarga
+    MAX_WORKERS = 8  # Threads; conexões simultâneas limitadas por HOST_LIMITS
     MAX_RETRIES = 4  # Aumentado número de tentativas
     
     # Criar diretório de saída
@@ -264,16 +911,31 @@ def main():
         print("[ERRO] Nenhuma URL encontrada no arquivo")
         return
     
+    # Amostras já concluídas em execuções anteriores
+    registry = load_registry(output_dir)
+    
+    # Referência servida do disco em vez da EBI para todas as amostras
+    configure_ref_cache(ref_fasta, ref_cache)
+    
+    # Regiões preparadas uma vez e compartilhadas por todos os samtools
+    bed_file = prepare_merged_bed(bed_file, output_dir)
+    
+    # Interpretar cada URL uma vez e alternar servidores na fila de submissão
+    jobs = [make_job(url, output_dir) for url in urls]
+    jobs = interleave_by_source(deduplicate_jobs(jobs, registry))
+    
     # Separar por fonte de dados para estatísticas
     sources = {}
-    for url in urls:
-        source = get_data_source(url)
-        sources[source] = sources.get(source, 0) + 1
+    for job in jobs:
+        sources[job.source] = sources.get(job.source, 0) + 1
     
-    print(f"[INFO] Encontradas {len(urls)} amostras para processar")
+    print(f"[INFO] Encontradas {len(jobs)} amostras para processar")
     for source, count in sources.items():
         print(f"[INFO]   {source}: {count} amostras")
-    print(f"[INFO] Usando {MAX_WORKERS} threads paralelas")
+    print(f"[INFO] Usando {MAX_WORKERS} threads")
+    for source, (limit, interval) in HOST_LIMITS.items():
+        if source in sources:
+            print(f"[INFO]   {source}: até {limit} conexões, intervalo mínimo de {interval}s")
     print(f"[INFO] Máximo de {MAX_RETRIES} tentativas por amostra")
     print("-" * 70)
     
@@ -283,17 +945,31 @@ def main():
     already_exists = 0
     start_time = time.time()
     
+    # A partir daqui as mensagens das threads passam pela fila de log
+    log_listener = start_logging(os.path.join(output_dir, JSON_LOG_FILE))
+    
     # Processar em paralelo
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    stop_watchdog = Event()
+    interrupted = False
+    try:
         # Submeter todas as tarefas
-        future_to_url = {
-            executor.submit(process_sample_with_retry, url, bed_file, output_dir, MAX_RETRIES): url 
-            for url in urls
+        future_to_job = {
+            executor.submit(process_sample_with_retry, job, bed_file, output_dir, MAX_RETRIES, registry): job 
+            for job in jobs
         }
         
+        # Vigiar amostras lentas na reta final
+        Thread(
+            target=straggler_watchdog,
+            args=(stop_watchdog, len(jobs), lambda: len(jobs) - (successful + failed + already_exists)),
+            daemon=True
+        ).start()
+        
         # Processar resultados conforme completam
-        for future in concurrent.futures.as_completed(future_to_url):
-            url = future_to_url[future]
+        for future in concurrent.futures.as_completed(future_to_job):
+            job = future_to_job[future]
             try:
                 success, sample_id, message = future.result()
                 if success:
@@ -308,10 +984,25 @@ def main():
                     failed += 1
                     
             except Exception as exc:
-                sample_id = os.path.basename(url).split(".")[0]
-                safe_print(f"[ERRO] {sample_id}: Exceção não tratada: {exc}")
+                safe_print(f"[ERRO] {job.sample_id}: Exceção não tratada: {exc}")
                 failed += 1
     
+    except KeyboardInterrupt:
+        interrupted = True
+        safe_print("[AVISO] Interrompido: encerrando os samtools em andamento e cancelando as amostras pendentes")
+        stop_all_fetches()
+    
+    finally:
+        stop_watchdog.set()
+        # Amostras ainda na fila são canceladas; as em andamento terminam logo
+        # (samtools mortos e sem novas tentativas)
+        executor.shutdown(cancel_futures=True)
+        log_listener.stop()
+    
+    if interrupted:
+        print(f"[AVISO] Execução interrompida. Concluídas: {successful}, já existentes: {already_exists}, falhas: {failed}")
+        sys.exit(130)
+    
     # Relatório final
     total_time = time.time() - start_time
     print("-" * 70)
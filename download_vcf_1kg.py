@@ -13,25 +13,63 @@ chromosomes = [str(i) for i in range(1, 23)] + ["X"]
 OUT_DIR = "/home/lab/Downloads/VCF_WHOLEGENOME"
 os.makedirs(OUT_DIR, exist_ok=True)
 
+# Tentativas do próprio wget (com espera crescente entre elas)
+WGET_TRIES = 5
+WGET_WAITRETRY = 30
+
+# Bloco EOF do BGZF: um .vcf.gz baixado por inteiro termina com ele
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+def is_complete_bgzf(path):
+    """Confere se o arquivo termina com o bloco EOF do BGZF"""
+    try:
+        with open(path, "rb") as f:
+            f.seek(-len(BGZF_EOF), os.SEEK_END)
+            return f.read() == BGZF_EOF
+    except OSError:
+        return False
+
 def download_with_wget(url, out_path):
     """
-    Executa o comando wget para baixar com opção -c (continue).
+    Baixa com wget para <out_path>.part e renomeia ao final.
+    
+    O nome final só aparece quando o download terminou (e, para .vcf.gz,
+    o bloco EOF do BGZF está presente), então arquivos já existentes são
+    pulados sem consultar o servidor. Um .part de uma execução anterior é
+    retomado com -c.
     Retorna True se sucesso, False caso contrário.
     """
+    part_path = out_path + ".part"
+    if os.path.exists(out_path):
+        if not out_path.endswith(".gz") or is_complete_bgzf(out_path):
+            print(f"[SKIP] {out_path} já existe")
+            return True
+        # Download incompleto de versões antigas (sem .part): retomar dele
+        os.replace(out_path, part_path)
+
     cmd = [
         "wget",
         "-c",   # continue downloads interrompidos
-        "-O", out_path,
+        "--tries", str(WGET_TRIES),
+        "--waitretry", str(WGET_WAITRETRY),
+        "--retry-connrefused",
+        "-O", part_path,
         url
     ]
     try:
         subprocess.run(cmd, check=True)
-        print(f"[OK] {url} → {out_path}")
-        return True
     except subprocess.CalledProcessError as e:
         print(f"[ERRO] wget falhou para {url}: {e}")
         return False
 
+    if out_path.endswith(".gz") and not is_complete_bgzf(part_path):
+        print(f"[ERRO] {part_path} incompleto (sem bloco EOF BGZF); será retomado na próxima execução")
+        return False
+
+    os.replace(part_path, out_path)
+    print(f"[OK] {url} → {out_path}")
+    return True
+
 def download_chr(chrom):
     """
     Para um cromossomo, monta os nomes dos arquivos .vcf.gz e .tbi e
@@ -54,7 +92,7 @@ def download_chr(chrom):
 
     results = []
     for url, out_path in zip(urls, out_paths):
-        # Se já existe completamente (vcf + tbi), você pode pular, mas wget -c lida com isso.
+        # Arquivos já completos são pulados em download_with_wget
         res = download_with_wget(url, out_path)
         results.append(res)
     return results
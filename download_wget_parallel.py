@@ -1,16 +1,54 @@
 import concurrent.futures
+import os
 import subprocess
 from pathlib import Path
+from urllib.parse import urlsplit
 
 # Caminho para o arquivo com os links
 LINKS_FILE = "download.txt"
 # Quantidade de downloads simultâneos
 MAX_WORKERS = 3
 
+# Marcadores de fim de arquivo: um download completo termina com eles
+CRAM_EOF = bytes.fromhex("0f000000ffffffff0fe0454f46000000000100"
+                         "05bdd94f0001000606010001000100ee63014b")  # Container EOF (CRAM 3)
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+EOF_MARKERS = {".cram": CRAM_EOF, ".bam": BGZF_EOF, ".gz": BGZF_EOF}
+
+def tem_eof(caminho, marcador):
+    """Confere se o arquivo termina com o marcador de fim esperado"""
+    try:
+        with open(caminho, "rb") as f:
+            f.seek(-len(marcador), os.SEEK_END)
+            return f.read() == marcador
+    except OSError:
+        return False
+
 def baixar_arquivo(link):
-    """Executa o comando wget com --continue para baixar o arquivo."""
+    """
+    Baixa o arquivo com wget --continue para <nome>.part e renomeia ao final.
+
+    Arquivos com o nome final e o marcador de fim (CRAM/BAM/.gz) são pulados
+    sem consultar o servidor; um .part de execução anterior é retomado.
+    Versões antigas gravavam direto no nome final: sem o marcador (ou em
+    formatos sem marcador) o arquivo volta para .part e o wget -c confere.
+    """
+    destino = os.path.basename(urlsplit(link).path)
+    parcial = destino + ".part"
+    marcador = EOF_MARKERS.get(os.path.splitext(destino)[1])
+    if os.path.exists(destino):
+        if marcador and tem_eof(destino, marcador):
+            print(f"[✔] Já existe, pulando: {destino}")
+            return
+        os.replace(destino, parcial)
+
     try:
-        subprocess.run(["wget", "--continue", link], check=True)
+        subprocess.run(["wget", "--continue", "--tries", "5", "--retry-connrefused",
+                        "-O", parcial, link], check=True)
+        if marcador and not tem_eof(parcial, marcador):
+            print(f"[✘] {parcial} incompleto (sem marcador de fim); será retomado na próxima execução")
+            return
+        os.replace(parcial, destino)
         print(f"[✔] Download concluído: {link}")
     except subprocess.CalledProcessError as e:
         print(f"[✘] Erro ao baixar: {link}\n{e}")
@@ -2,6 +2,7 @@
 import os
 import re
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 # Caminhos
 vcf_dir = "/home/lab/Desktop/arq_joao/VCF_WHOLEGENOME"         # pasta onde estão os VCFs originais
@@ -9,26 +10,35 @@ bed_file = "/home/lab/Downloads/snps_positions.bed"            # arquivo BED com
 out_dir = "/home/lab/Desktop/arq_joao/VCF_WHOLEGENOME_filtred" # pasta de saída
 final_vcf = "/home/lab/Desktop/arq_joao/VCF_WHOLEGENOME_filtred/vcf_final_merged.vcf.gz"  # arquivo final concatenado
 
+# Paralelismo: cromossomos filtrados ao mesmo tempo e threads BGZF por bcftools
+VIEW_THREADS = 2
+MAX_WORKERS = max(1, (os.cpu_count() or VIEW_THREADS) // VIEW_THREADS)
+FINAL_THREADS = os.cpu_count() or 1  # concat/index final rodam sozinhos
+
 # Criar pasta de saída se não existir
 os.makedirs(out_dir, exist_ok=True)
 
+# Padrão do número do cromossomo no nome do arquivo (compilado uma vez)
+CHR_RE = re.compile(r"chr(\d+)")
+
 # Função para extrair número do cromossomo do nome do arquivo
 def get_chr_number(filename):
-    match = re.search(r"chr(\d+)", filename)
+    match = CHR_RE.search(filename)
     if match:
         return int(match.group(1))
     else:
         return 9999  # se não encontrar, manda pro fim
 
 # Listar todos os arquivos VCF da pasta (aceita .vcf e .vcf.gz)
-vcf_files = [f for f in os.listdir(vcf_dir) if f.endswith(".vcf") or f.endswith(".vcf.gz")]
+with os.scandir(vcf_dir) as entries:
+    vcf_files = [entry.name for entry in entries
+                 if entry.name.endswith((".vcf", ".vcf.gz")) and entry.is_file()]
 
 # Ordenar por número do cromossomo
 vcf_files_sorted = sorted(vcf_files, key=get_chr_number)
 
-filtrados = []  # lista de VCFs filtrados para concatenar
-
-for vcf in vcf_files_sorted:
+def filter_one(vcf):
+    """Filtra um VCF pelas regiões do BED e indexa o resultado."""
     input_path = os.path.join(vcf_dir, vcf)
     base_name = vcf.replace(".vcf.gz", "").replace(".vcf", "")
     output_name = base_name + ".filtered.vcf.gz"
@@ -37,6 +47,7 @@ for vcf in vcf_files_sorted:
     # Comando bcftools view
     cmd = [
         "bcftools", "view",
+        "--threads", str(VIEW_THREADS),
         "-R", bed_file,
         "-Oz",
         "-o", output_path,
@@ -47,15 +58,26 @@ for vcf in vcf_files_sorted:
     subprocess.run(cmd, check=True)
     
     # Indexar VCF filtrado
-    subprocess.run(["bcftools", "index", output_path], check=True)
+    subprocess.run(["bcftools", "index", "--threads", str(VIEW_THREADS), output_path], check=True)
+    
+    return output_path
 
-    filtrados.append(output_path)
+# Cromossomos são independentes: filtrar em paralelo (map mantém a ordem
+# por cromossomo, que a concatenação exige)
+with ThreadPoolExecutor(max_workers=min(len(vcf_files_sorted), MAX_WORKERS) or 1) as executor:
+    filtrados = list(executor.map(filter_one, vcf_files_sorted))  # lista de VCFs filtrados para concatenar
 
 # Concatenar todos os VCFs filtrados em um único
 if filtrados:
     print("🔗 Concatenando todos os VCFs filtrados em", final_vcf)
-    cmd_concat = ["bcftools", "concat", "-Oz", "-o", final_vcf] + filtrados
-    subprocess.run(cmd_concat, check=True)
-    subprocess.run(["bcftools", "index", final_vcf], check=True)
+    try:
+        # --naive copia os blocos BGZF sem decodificar os registros
+        subprocess.run(["bcftools", "concat", "--threads", str(FINAL_THREADS), "--naive",
+                        "-Oz", "-o", final_vcf] + filtrados, check=True)
+    except subprocess.CalledProcessError:
+        print("⚠️  concat --naive recusado (cabeçalhos diferentes); usando concat normal")
+        subprocess.run(["bcftools", "concat", "--threads", str(FINAL_THREADS),
+                        "-Oz", "-o", final_vcf] + filtrados, check=True)
+    subprocess.run(["bcftools", "index", "--threads", str(FINAL_THREADS), final_vcf], check=True)
 
 print("✅ Processo concluído! VCF final gerado em:", final_vcf)
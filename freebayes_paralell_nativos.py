@@ -3,7 +3,7 @@
 import os
 import subprocess
 import sys
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import tempfile
 import resource
 import math
@@ -16,63 +16,254 @@ BED_FILE = "/home/lab/Desktop/arq_joao/ANCESTRY_PANEL/reference_panel.bed" #Arqu
 OUTPUT_DIR = "/home/lab/Desktop/arq_joao/ANCESTRY_PANEL/freebayes" #Diretório de saida dos vcfs
 FINAL_VCF = "HGDP_51_NATIVO_AMERICANOS.vcf.gz" #Nome do vcf final
 MAX_PARALLEL_JOBS = 4 #Número de threads
+MAX_COVERAGE_PER_SAMPLE = 200 #Profundidade média por amostra acima da qual o freebayes pula o sítio
 ##############################################################################################
 
+# Regiões do BED maiores que isso são quebradas em pedaços (balanceamento);
+# regiões menores e consecutivas são agrupadas até esse total num só job
+SUBREGION_BP = 500_000
+
+# Limites por região: alelos avaliados pelo freebayes (evita explosão em
+# regiões repetitivas) e tempo máximo antes de desistir da região
+BEST_N_ALLELES = 4
+REGION_TIMEOUT = 4 * 3600  # segundos
+
+# Threads de (de)compressão BGZF do bcftools: divididas entre os jobs na
+# fase paralela; a fase final (concat/norm/index) roda sozinha e usa todas
+CPU_COUNT = os.cpu_count() or 1
+THREADS_PER_JOB = max(1, CPU_COUNT // MAX_PARALLEL_JOBS)
+FINAL_THREADS = CPU_COUNT
+
+# Threads para verificar os arquivos de regiões já existentes (e os BAMs)
+VALIDATION_WORKERS = 32
+QUICKCHECK_BATCH = 16  # BAMs por chamada do samtools quickcheck
+
+# Threads para remover os arquivos das regiões ao final
+CLEANUP_WORKERS = 16
+
+# Bloco EOF do BGZF: todo BCF/VCF.gz gravado por completo termina com ele
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
 # Configurações para concatenação
 BATCH_SIZE = 500  # Processar em lotes menores varias vezes pra concatenar
 MAX_OPEN_FILES = 900  # Limite seguro de arquivos abertos
+FORCE_NORM = False  # Concat com --allow-overlaps + bcftools norm -d mesmo com regiões do BED disjuntas
+FD_RESERVE = 128  # Descritores reservados ao próprio bcftools (fora os VCFs do lote)
 
 def increase_file_limits():
     """Aumenta os limites de arquivos abertos quando possível."""
-    try:
-        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
-        # Tenta aumentar para o máximo permitido
-        new_soft = min(hard, 8192)
-        resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
-        print(f"Limite de arquivos aumentado para: {new_soft}")
-        return new_soft
-    except:
-        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
-        print(f"Mantendo limite atual de arquivos: {soft}")
-        return soft
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    # Tenta o máximo permitido (hard) e, se o sistema recusar, 8192
+    for new_soft in (hard, min(hard, 8192)):
+        if new_soft == resource.RLIM_INFINITY or new_soft <= soft:
+            continue
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+            print(f"Limite de arquivos aumentado para: {new_soft}")
+            return new_soft
+        except (ValueError, OSError):
+            pass
+    print(f"Mantendo limite atual de arquivos: {soft}")
+    return soft
 
 def create_bamlist():
-    """Cria lista de BAMs do diretório."""
+    """
+    Cria lista de BAMs do diretório (todos precisam estar indexados e íntegros).
+    
+    Um BAM sem índice (.bam.bai, .bai ou .bam.csi) aborta a execução com a
+    lista dos arquivos: o freebayes com -r falharia em todas as regiões, e
+    tirar a amostra da chamada conjunta mudaria o conjunto de amostras. Os
+    nomes vêm da mesma varredura do diretório, sem um stat por arquivo de
+    índice.
+    """
+    with os.scandir(BAM_DIRECTORY) as entries:
+        entries = list(entries)
+    names = {entry.name for entry in entries}
+    
     bam_files = []
-    for file_name in os.listdir(BAM_DIRECTORY):
-        if file_name.lower().endswith('.bam'):
-            bam_files.append(os.path.join(BAM_DIRECTORY, file_name))
+    unindexed = []
+    for entry in entries:
+        if not (entry.name.lower().endswith('.bam') and entry.is_file()):
+            continue
+        stem = entry.name[:-len('.bam')]
+        bam_files.append(entry.path)
+        if not {entry.name + '.bai', stem + '.bai', entry.name + '.csi'} & names:
+            unindexed.append(entry.name)
+    
+    if unindexed:
+        print(f"❌ Erro: {len(unindexed)} BAM(s) sem índice (.bai/.csi) em {BAM_DIRECTORY}:")
+        for name in sorted(unindexed):
+            print(f"  - {name}")
+        print("Indexe com 'samtools index' e rode novamente.")
+        sys.exit(1)
+    
+    # samtools quickcheck lê só cabeçalho e bloco EOF de cada BAM; com -v
+    # lista no stdout os que falharam. Lotes de QUICKCHECK_BATCH BAMs por
+    # chamada, em threads: as leituras (ex.: disco de rede) se sobrepõem
+    def quickcheck(batch):
+        result = subprocess.run(["samtools", "quickcheck", "-v"] + batch, capture_output=True)
+        return result.stdout.decode().splitlines()
+    
+    batches = [bam_files[i:i + QUICKCHECK_BATCH] for i in range(0, len(bam_files), QUICKCHECK_BATCH)]
+    with ThreadPoolExecutor(max_workers=VALIDATION_WORKERS) as executor:
+        bad_bams = {bam_file for failed in executor.map(quickcheck, batches) for bam_file in failed}
+    # Um BAM ruim aborta a execução em vez de sair da chamada conjunta: uma
+    # retomada misturaria BCFs de regiões com conjuntos de amostras diferentes
+    if bad_bams:
+        print(f"❌ Erro: {len(bad_bams)} BAM(s) inválido(s) ou truncado(s) (samtools quickcheck):")
+        for bam_file in sorted(bad_bams):
+            print(f"  - {os.path.basename(bam_file)}")
+        sys.exit(1)
     
     bam_files.sort()
     bamlist_file = os.path.join(OUTPUT_DIR, "bamlist_temp.txt")
     
     with open(bamlist_file, 'w') as f:
-        for bam_file in bam_files:
-            f.write(f"{bam_file}\n")
+        f.write("".join(f"{bam_file}\n" for bam_file in bam_files))
     
     print(f"Criada lista com {len(bam_files)} arquivos BAM")
-    return bamlist_file
+    return bamlist_file, bam_files
 
 def read_bed_regions(bed_file):
-    """Lê regiões do BED."""
+    """
+    Lê regiões do BED (em bytes, decodificando só a região montada).
+    
+    Regiões maiores que SUBREGION_BP são quebradas em pedaços consecutivos
+    para equilibrar a carga entre os workers. O ID de cada região é o
+    número da linha no BED (usado no nome do arquivo); pedaços recebem o
+    sufixo _NNN, mantendo a ordem do BED na concatenação.
+    
+    Cada região sai como (região chr:início-fim, ID, chr, início, fim): as
+    coordenadas já convertidas seguem junto, sem reparsear a string depois.
+    """
     regions = []
-    with open(bed_file, 'r') as f:
-        for line_num, line in enumerate(f, 1):
-            line = line.strip()
-            if not line or line.startswith('#'):
+    line_num = 0
+    with open(bed_file, 'rb') as f:
+        for line in f:
+            line_num += 1
+            if line[:1] == b'#' or not line.strip():
                 continue
             
-            parts = line.split('\t')
+            parts = line.split(b'\t', 3)
             if len(parts) < 3:
                 continue
             
-            chrom, start, end = parts[0], parts[1], parts[2]
-            region = f"{chrom}:{start}-{end}"
-            regions.append((region, line_num))
+            try:
+                start, end = int(parts[1]), int(parts[2])
+            except ValueError:
+                continue  # Cabeçalho/linha sem coordenadas numéricas
+            chrom = parts[0].strip().decode()
+            if end - start <= SUBREGION_BP:
+                regions.append((f"{chrom}:{start}-{end}", f"{line_num:04d}", chrom, start, end))
+                continue
+            
+            for piece, sub_start in enumerate(range(start, end, SUBREGION_BP)):
+                sub_end = min(sub_start + SUBREGION_BP, end)
+                regions.append((f"{chrom}:{sub_start}-{sub_end}", f"{line_num:04d}_{piece:03d}",
+                                chrom, sub_start, sub_end))
     
     print(f"Lidas {len(regions)} regiões do arquivo BED")
     return regions
 
+def bin_regions(regions):
+    """
+    Agrupa regiões consecutivas do BED (mesmo cromossomo) em blocos de até
+    SUBREGION_BP pb somados.
+    
+    Painéis com milhares de regiões pequenas viravam milhares de execuções
+    do freebayes (e de BCFs para concatenar); cada bloco roda num freebayes
+    só, com as regiões como alvos (-t). Os blocos seguem a ordem do BED e
+    usam o ID da primeira região, então o nome region_<ID>.bcf continua
+    ordenando a concatenação. Cada bloco sai como (chr:início-fim, ID, chr,
+    início, fim, [(início, fim), ...]).
+    """
+    bins = []
+    group, group_bp = [], 0
+    
+    def close_group():
+        _, first_id, chrom, _, _ = group[0]
+        start = min(entry[3] for entry in group)
+        end = max(entry[4] for entry in group)
+        intervals = [(entry[3], entry[4]) for entry in group]
+        bins.append((f"{chrom}:{start}-{end}", first_id, chrom, start, end, intervals))
+    
+    for entry in regions:
+        length = entry[4] - entry[3]
+        if group and (entry[2] != group[0][2] or group_bp + length > SUBREGION_BP):
+            close_group()
+            group, group_bp = [], 0
+        group.append(entry)
+        group_bp += length
+    if group:
+        close_group()
+    
+    print(f"{len(regions)} regiões agrupadas em {len(bins)} jobs do FreeBayes")
+    return bins
+
+def region_sort_key(path):
+    """Ordem do BED a partir do nome region_<linha>[_<pedaço>].bcf."""
+    region_id = os.path.basename(path)[len("region_"):].split('.')[0]
+    return tuple(int(part) for part in region_id.split('_'))
+
+def bed_regions_disjoint(regions):
+    """
+    Verifica se as regiões (na ordem do BED) são ordenadas e não se sobrepõem.
+    
+    Nesse caso a concatenação na ordem das regiões já sai ordenada e sem
+    variantes repetidas, e o bcftools norm -d final pode ser pulado.
+    """
+    seen_chroms = set()
+    prev_chrom, prev_end = None, 0
+    for _, _, chrom, start, end in regions:
+        if chrom != prev_chrom:
+            if chrom in seen_chroms:
+                return False  # cromossomo reaparece mais adiante: fora de ordem
+            seen_chroms.add(chrom)
+        elif start < prev_end:
+            return False
+        prev_chrom, prev_end = chrom, end
+    return True
+
+def has_bgzf_eof(path):
+    """
+    Verifica se o arquivo BGZF (BCF/VCF.gz) termina com o bloco EOF.
+    
+    Um arquivo interrompido no meio da escrita não tem esse bloco; ler 28
+    bytes é bem mais barato que abrir um bcftools por arquivo.
+    """
+    try:
+        with open(path, 'rb') as fh:
+            fh.seek(-len(BGZF_EOF), os.SEEK_END)
+            return fh.read(len(BGZF_EOF)) == BGZF_EOF
+    except OSError:
+        return False
+
+def chrom_read_density(bam_files):
+    """
+    Leituras mapeadas por pb em cada cromossomo, somadas entre os BAMs.
+    
+    O samtools idxstats lê só o índice (.bai/.csi), sem descomprimir as
+    leituras; BAMs em que ele falhar simplesmente não contam.
+    """
+    def idxstats(bam_file):
+        result = subprocess.run(["samtools", "idxstats", bam_file], capture_output=True)
+        return result.stdout if result.returncode == 0 else b""
+    
+    density = {}
+    with ThreadPoolExecutor(max_workers=VALIDATION_WORKERS) as executor:
+        for stats in executor.map(idxstats, bam_files):
+            for line in stats.splitlines():
+                chrom, length, mapped = line.split(b'\t')[:3]
+                if int(length) > 0:
+                    chrom = chrom.decode()
+                    density[chrom] = density.get(chrom, 0.0) + int(mapped) / int(length)
+    return density
+
+def region_weight(entry, density, default_density):
+    """Trabalho estimado do bloco: pb dos alvos x leituras por pb no cromossomo."""
+    chrom, intervals = entry[2], entry[5]
+    return sum(end - start for start, end in intervals) * density.get(chrom, default_density)
+
 def check_existing_vcfs(regions, output_dir):
     """Verifica quais VCFs já existem e estão válidos."""
     existing_vcfs = []
@@ -81,41 +272,32 @@ def check_existing_vcfs(regions, output_dir):
     
     print("Verificando VCFs existentes...")
     
-    for region, region_id in regions:
-        vcf_file = os.path.join(output_dir, f"region_{region_id:04d}.vcf.gz")
-        idx_file = vcf_file + ".tbi"
+    def validate_one(entry):
+        region_id = entry[1]
+        vcf_file = os.path.join(output_dir, f"region_{region_id}.bcf")
+        idx_file = vcf_file + ".csi"
         
         # Verifica se o arquivo existe e tem tamanho > 0
-        if os.path.exists(vcf_file) and os.path.getsize(vcf_file) > 0:
-            # Verifica se o índice existe
-            if os.path.exists(idx_file):
-                # Testa se o arquivo é válido
-                try:
-                    # Teste rápido: tenta ler o cabeçalho
-                    result = subprocess.run([
-                        "bcftools", "view", "-h", vcf_file
-                    ], capture_output=True, check=True)
-                    
-                    existing_vcfs.append(vcf_file)
-                    
-                except subprocess.CalledProcessError:
-                    print(f"  ⚠️  VCF corrompido: {vcf_file}")
-                    invalid_vcfs.append((vcf_file, idx_file))
-                    missing_regions.append((region, region_id))
-            else:
-                print(f"  ⚠️  Falta índice para: {vcf_file}")
-                # Tenta criar o índice
-                try:
-                    subprocess.run(["bcftools", "index", "-f", "-t", vcf_file], 
-                                  check=True, capture_output=True)
-                    existing_vcfs.append(vcf_file)
-                    print(f"  ✅ Índice criado para: {vcf_file}")
-                except subprocess.CalledProcessError:
-                    print(f"  ❌ Erro ao indexar: {vcf_file}")
-                    invalid_vcfs.append((vcf_file, None))
-                    missing_regions.append((region, region_id))
-        else:
-            missing_regions.append((region, region_id))
+        if not (os.path.exists(vcf_file) and os.path.getsize(vcf_file) > 0):
+            return "missing", None
+        
+        # Testa se o arquivo é válido (terminou de ser escrito). Índice não é
+        # exigido: o concat --naive não usa
+        if has_bgzf_eof(vcf_file):
+            return "ok", vcf_file
+        print(f"  ⚠️  VCF corrompido: {vcf_file}")
+        return "invalid", (vcf_file, idx_file)
+    
+    # Verificação é só I/O (stat, leitura do final do arquivo): threads
+    # sobrepõem as latências
+    with ThreadPoolExecutor(max_workers=VALIDATION_WORKERS) as executor:
+        for entry, (status, payload) in zip(regions, executor.map(validate_one, regions)):
+            if status == "ok":
+                existing_vcfs.append(payload)
+                continue
+            if status == "invalid":
+                invalid_vcfs.append(payload)
+            missing_regions.append(entry)
     
     # Remove arquivos corrompidos
     for vcf_file, idx_file in invalid_vcfs:
@@ -135,59 +317,206 @@ def check_existing_vcfs(regions, output_dir):
     
     return existing_vcfs, missing_regions
 
+# Parâmetros comuns a todas as regiões, definidos uma vez por worker
+_worker_config = {}
+
+def init_worker(output_dir, bamlist_file, reference, skip_coverage):
+    """
+    Guarda no worker os parâmetros iguais para todas as regiões
+    
+    Assim cada tarefa enviada ao pool carrega só (região, ID).
+    """
+    _worker_config.update(output_dir=output_dir, bamlist_file=bamlist_file,
+                          reference=reference, skip_coverage=skip_coverage)
+
 def run_freebayes_region(args):
-    """Executa FreeBayes para uma região."""
-    region, region_id, output_dir, bamlist_file, reference = args
+    """
+    Executa FreeBayes para um bloco de regiões, gravando BCF direto do pipe.
+    
+    Bloco de uma região só usa -r; com várias, as regiões vão como BED de
+    alvos pelo stdin do freebayes (-t /dev/stdin), sem arquivo temporário.
+    """
+    region, region_id, intervals = args[0], args[1], args[5]
+    output_dir = _worker_config["output_dir"]
+    bamlist_file = _worker_config["bamlist_file"]
+    reference = _worker_config["reference"]
+    skip_coverage = _worker_config["skip_coverage"]
     
-    vcf_file = os.path.join(output_dir, f"region_{region_id:04d}.vcf.gz")
-    vcf_temp = vcf_file.replace('.gz', '')
+    bcf_file = os.path.join(output_dir, f"region_{region_id}.bcf")
+    targets = None
+    
+    if len(intervals) == 1:
+        target_args = ["-r", region]
+    else:
+        chrom = args[2]
+        targets = "".join(f"{chrom}\t{start}\t{end}\n" for start, end in intervals).encode()
+        target_args = ["-t", "/dev/stdin"]
     
     cmd = [
         "freebayes",
         "-L", bamlist_file,
         "-f", reference,
-        "-r", region
+        *target_args,
+        "--use-best-n-alleles", str(BEST_N_ALLELES),
+        "--skip-coverage", str(skip_coverage)
     ]
     
     try:
-        print(f"  Processando região {region_id}: {region}")
+        print(f"  Processando região {region_id}: {region} ({len(intervals)} alvos)")
+        
+        # freebayes | bcftools view -Ob: sem VCF temporário em texto, sem uma
+        # segunda passada para comprimir e sem índice (o concat --naive não usa)
+        # (stderr do freebayes vai para arquivo temporário: um PIPE não lido
+        # travaria o freebayes se ele escrevesse muito)
+        with tempfile.TemporaryFile() as freebayes_log:
+            freebayes = subprocess.Popen(cmd, stdin=subprocess.PIPE if targets else subprocess.DEVNULL,
+                                         stdout=subprocess.PIPE, stderr=freebayes_log)
+            if targets:
+                # freebayes lê todos os alvos antes de começar a chamar variantes
+                try:
+                    freebayes.stdin.write(targets)
+                except BrokenPipeError:
+                    pass  # freebayes saiu cedo; o erro aparece no returncode
+                finally:
+                    freebayes.stdin.close()
+            try:
+                convert = subprocess.run(["bcftools", "view", "--threads", str(THREADS_PER_JOB),
+                                          "-O", "b", "-o", bcf_file],
+                                         stdin=freebayes.stdout, capture_output=True,
+                                         timeout=REGION_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                freebayes.kill()
+                raise
+            finally:
+                freebayes.stdout.close()
+                freebayes.wait()
+            freebayes_log.seek(0)
+            freebayes_err = freebayes_log.read()
         
-        with open(vcf_temp, 'w') as vcf_out:
-            result = subprocess.run(cmd, stdout=vcf_out, stderr=subprocess.PIPE, check=True)
+        if freebayes.returncode != 0:
+            raise subprocess.CalledProcessError(freebayes.returncode, cmd, stderr=freebayes_err)
+        if convert.returncode != 0:
+            raise subprocess.CalledProcessError(convert.returncode, convert.args, stderr=convert.stderr)
         
         # Verifica se o arquivo foi criado e não está vazio
-        if not os.path.exists(vcf_temp) or os.path.getsize(vcf_temp) == 0:
-            if os.path.exists(vcf_temp):
-                os.remove(vcf_temp)
+        if not os.path.exists(bcf_file) or os.path.getsize(bcf_file) == 0:
+            for path in (bcf_file, bcf_file + ".csi"):
+                if os.path.exists(path):
+                    os.remove(path)
             return None
         
-        # Comprime
-        subprocess.run(["bcftools", "view", "-O", "z", "-o", vcf_file, vcf_temp], 
-                      check=True, capture_output=True)
-        os.remove(vcf_temp)
-        
-        # Indexa
-        subprocess.run(["bcftools", "index", "-f", "-t", vcf_file], 
-                      check=True, capture_output=True)
-        
         print(f"  ✅ Concluído região {region_id}: {region}")
-        return vcf_file
+        return bcf_file
         
     except subprocess.CalledProcessError as e:
         print(f"  ❌ Erro na região {region} (ID: {region_id}): {e.stderr.decode() if e.stderr else str(e)}")
-        if os.path.exists(vcf_temp):
-            os.remove(vcf_temp)
+        for path in (bcf_file, bcf_file + ".csi"):
+            if os.path.exists(path):
+                os.remove(path)
+        return None
+    
+    except subprocess.TimeoutExpired:
+        print(f"  ❌ Região {region} (ID: {region_id}) excedeu {REGION_TIMEOUT}s e foi interrompida")
+        for path in (bcf_file, bcf_file + ".csi"):
+            if os.path.exists(path):
+                os.remove(path)
         return None
 
-def concatenate_vcfs_in_batches(vcf_files, output_file, batch_size=BATCH_SIZE):
-    """Concatena VCFs em lotes menores para evitar limite de arquivos abertos."""
-    vcf_files.sort()
+def run_concat(files, output_file, naive=True):
+    """
+    Concatena os arquivos em BCF, passando a lista pelo stdin.
+    
+    Com naive=True (regiões do BED ordenadas e disjuntas) usa --naive, que
+    copia os blocos BGZF sem decodificar os registros; todas as regiões vêm
+    do mesmo bamlist, então os cabeçalhos são iguais. Se o bcftools recusar
+    (cabeçalhos diferentes), refaz com o concat normal. Com naive=False vai
+    direto ao concat normal: o --naive só emenda os blocos, sem ordenar nem
+    remover as variantes repetidas de regiões sobrepostas.
+    """
+    file_list = "".join(f"{path}\n" for path in files).encode()
+    if naive:
+        try:
+            subprocess.run([
+                "bcftools", "concat",
+                "--threads", str(FINAL_THREADS),
+                "--naive",
+                "-f", "-",
+                "-O", "b",
+                "-o", output_file
+            ], input=file_list, check=True, capture_output=True)
+            return
+        except subprocess.CalledProcessError as e:
+            print(f"  ⚠️  concat --naive falhou ({e.stderr.decode().strip() if e.stderr else e}); usando concat normal")
+    
+    # O concat normal com --allow-overlaps exige índice nas entradas
+    for path in files:
+        if not os.path.exists(path + ".csi"):
+            subprocess.run(["bcftools", "index", "--threads", str(FINAL_THREADS), "-f", path],
+                           check=True, capture_output=True)
+    subprocess.run([
+        "bcftools", "concat",
+        "--threads", str(FINAL_THREADS),
+        "-f", "-",
+        "-O", "b",
+        "--allow-overlaps",
+        "--remove-duplicates",
+        "-o", output_file
+    ], input=file_list, check=True, capture_output=True)
+
+def run_concat_piped(files, final_cmd):
+    """
+    Concatena os arquivos com --naive direto no stdin de final_cmd.
+    
+    Retorna False se o concat --naive recusar (cabeçalhos diferentes), para
+    o chamador refazer com run_concat em arquivo; erro do final_cmd sobe
+    como CalledProcessError.
+    """
+    file_list = "".join(f"{path}\n" for path in files).encode()
+    with tempfile.TemporaryFile() as concat_log:
+        concat = subprocess.Popen([
+            "bcftools", "concat",
+            "--threads", str(FINAL_THREADS),
+            "--naive",
+            "-f", "-",
+            "-O", "b"
+        ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=concat_log)
+        try:
+            concat.stdin.write(file_list)
+            concat.stdin.close()
+            final = subprocess.run(final_cmd + ["-"], stdin=concat.stdout, capture_output=True)
+        finally:
+            concat.stdout.close()
+            concat.wait()
+        concat_log.seek(0)
+        concat_err = concat_log.read()
+    
+    if concat.returncode != 0:
+        print(f"  ⚠️  concat --naive falhou ({concat_err.decode().strip()}); usando concat normal")
+        return False
+    if final.returncode != 0:
+        raise subprocess.CalledProcessError(final.returncode, final.args, stderr=final.stderr)
+    return True
+
+def concatenate_vcfs_in_batches(vcf_files, output_file, batch_size=BATCH_SIZE, deduplicate=True,
+                                naive=True):
+    """
+    Concatena VCFs em lotes menores para evitar limite de arquivos abertos.
+    
+    Com deduplicate=False (regiões do BED disjuntas, ver bed_regions_disjoint)
+    o bcftools norm -d é dispensado e o BCF concatenado só é convertido
+    para VCF.gz. Com naive=False (regiões sobrepostas ou fora de ordem) os
+    concats usam --allow-overlaps --remove-duplicates em vez de --naive.
+    """
+    # Ordem numérica do ID da região (= ordem do BED); a ordem alfabética
+    # colocaria region_10000 antes de region_2000
+    vcf_files.sort(key=region_sort_key)
     num_files = len(vcf_files)
     num_batches = math.ceil(num_files / batch_size)
     
     print(f"Concatenando {num_files} arquivos VCF em {num_batches} lotes...")
     
     batch_files = []
+    merged_bcf = os.path.join(OUTPUT_DIR, "concat_temp.bcf")
     
     try:
         # Primeira fase: criar lotes intermediários
@@ -196,127 +525,111 @@ def concatenate_vcfs_in_batches(vcf_files, output_file, batch_size=BATCH_SIZE):
             end_idx = min(start_idx + batch_size, num_files)
             batch_vcfs = vcf_files[start_idx:end_idx]
             
-            batch_output = os.path.join(OUTPUT_DIR, f"batch_{batch_num:04d}.vcf.gz")
+            batch_output = os.path.join(OUTPUT_DIR, f"batch_{batch_num:04d}.bcf")
             
             print(f"Processando lote {batch_num + 1}/{num_batches} ({len(batch_vcfs)} arquivos)...")
             
-            # Cria arquivo de lista para este lote
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as tmp_file:
-                for vcf_file in batch_vcfs:
-                    tmp_file.write(f"{vcf_file}\n")
-                batch_list_file = tmp_file.name
-            
-            try:
-                # Concatena este lote
-                subprocess.run([
-                    "bcftools", "concat",
-                    "-f", batch_list_file,
-                    "-O", "z",
-                    "--allow-overlaps",
-                    "--remove-duplicates",
-                    "-o", batch_output
-                ], check=True, capture_output=True)
-                
-                # Indexa o lote
-                subprocess.run(["bcftools", "index", "-f", "-t", batch_output], 
-                              check=True, capture_output=True)
-                
-                batch_files.append(batch_output)
-                
-            finally:
-                os.unlink(batch_list_file)
+            # Concatena este lote
+            run_concat(batch_vcfs, batch_output, naive)
+            batch_files.append(batch_output)
+        
+        # Grava com nome temporário: uma execução interrompida não deixa um
+        # arquivo final truncado no lugar do anterior
+        partial_file = output_file + ".part"
+        
+        if deduplicate:
+            # Remove duplicatas (regiões sobrepostas do BED) e grava o arquivo final
+            print("Removendo duplicatas e normalizando...")
+            final_cmd = [
+                "bcftools", "norm",
+                "--threads", str(FINAL_THREADS),
+                "-d", "all",  # Remove todas as duplicatas
+                "-O", "z",
+                "-o", partial_file
+            ]
+        else:
+            # Regiões disjuntas não geram duplicatas: só converte para VCF.gz
+            print("Regiões do BED disjuntas: pulando remoção de duplicatas")
+            final_cmd = [
+                "bcftools", "view",
+                "--threads", str(FINAL_THREADS),
+                "-O", "z",
+                "-o", partial_file
+            ]
         
         # Segunda fase: concatenar os lotes
         if len(batch_files) == 1:
-            # Se só há um lote, apenas renomeia
-            os.rename(batch_files[0], output_file)
-            os.rename(batch_files[0] + ".tbi", output_file + ".tbi")
+            # Se só há um lote, ele já é o arquivo concatenado
+            merged_bcf = batch_files[0]
+            subprocess.run(final_cmd + [merged_bcf], check=True, capture_output=True)
         else:
             print(f"Concatenando {len(batch_files)} lotes finais...")
             
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as tmp_file:
-                for batch_file in batch_files:
-                    tmp_file.write(f"{batch_file}\n")
-                final_list_file = tmp_file.name
-            
-            try:
-                # Concatenação final
-                subprocess.run([
-                    "bcftools", "concat",
-                    "-f", final_list_file,
-                    "-O", "z",
-                    "--allow-overlaps",
-                    "--remove-duplicates",
-                    "-o", output_file
-                ], check=True, capture_output=True)
-                
-            finally:
-                os.unlink(final_list_file)
-        
-        # Remove duplicatas e normaliza o arquivo final
-        temp_final = output_file.replace('.vcf.gz', '_normalized.vcf.gz')
+            # concat --naive | norm/view: o BCF concatenado não passa pelo disco.
+            # Regiões sobrepostas/fora de ordem (ou cabeçalhos diferentes entre
+            # os lotes): concat normal em arquivo
+            if not (naive and run_concat_piped(batch_files, final_cmd)):
+                run_concat(batch_files, merged_bcf, naive)
+                subprocess.run(final_cmd + [merged_bcf], check=True, capture_output=True)
         
-        print("Removendo duplicatas e normalizando...")
-        subprocess.run([
-            "bcftools", "norm",
-            "-d", "all",  # Remove todas as duplicatas
-            "-O", "z",
-            "-o", temp_final,
-            output_file
-        ], check=True, capture_output=True)
-        
-        # Substitui pelo arquivo normalizado
-        os.rename(temp_final, output_file)
+        # Só aparece com o nome final depois de escrito por completo
+        os.replace(partial_file, output_file)
         
         # Indexa o arquivo final
-        subprocess.run(["bcftools", "index", "-f", "-t", output_file], 
+        subprocess.run(["bcftools", "index", "--threads", str(FINAL_THREADS), "-f", "-t", output_file], 
                       check=True, capture_output=True)
         
         print(f"Arquivo final criado: {output_file}")
         
     finally:
         # Limpa arquivos temporários de lote
-        for batch_file in batch_files:
+        if os.path.exists(output_file + ".part"):
+            os.remove(output_file + ".part")
+        for batch_file in batch_files + [merged_bcf]:
             if os.path.exists(batch_file):
                 os.remove(batch_file)
-            if os.path.exists(batch_file + ".tbi"):
-                os.remove(batch_file + ".tbi")
+            if os.path.exists(batch_file + ".csi"):
+                os.remove(batch_file + ".csi")
 
 def cleanup_temp_files(successful_vcfs):
     """Remove arquivos VCF temporários após concatenação."""
     print("Limpando arquivos temporários...")
-    removed_count = 0
-    for vcf_file in successful_vcfs:
+    
+    def remove(path):
+        # Sem os.path.exists antes: um unlink só, ausente conta como removido
         try:
-            if os.path.exists(vcf_file):
-                os.remove(vcf_file)
-                removed_count += 1
-            
-            # Remove índice também
-            idx_file = vcf_file + ".tbi"
-            if os.path.exists(idx_file):
-                os.remove(idx_file)
+            os.remove(path)
+            return True
         except OSError:
-            pass  # Ignora erros de remoção
+            return False  # Ignora erros de remoção
     
+    # Remove índice também (de execuções antigas, se houver)
+    paths = [path for vcf_file in successful_vcfs for path in (vcf_file, vcf_file + ".csi")]
+    
+    # unlink é só I/O: em paralelo as latências (ex.: disco de rede) se sobrepõem
+    with ThreadPoolExecutor(max_workers=CLEANUP_WORKERS) as executor:
+        removed = list(executor.map(remove, paths))
+    
+    removed_count = sum(removed[0::2])  # só os VCFs, como antes
     print(f"Removidos {removed_count} arquivos temporários")
 
 def get_vcf_stats(vcf_file):
     """Obtém estatísticas básicas do VCF final."""
     try:
-        # Conta variantes
+        # Conta variantes (lido do índice .tbi, sem percorrer o arquivo)
         result = subprocess.run([
-            "bcftools", "view", "-H", vcf_file, "|", "wc", "-l"
-        ], shell=True, capture_output=True, text=True, check=True)
+            "bcftools", "index", "-n", vcf_file
+        ], capture_output=True, check=True)
         
-        variant_count = result.stdout.strip()
+        # Saída em bytes: int() aceita direto, sem decodificar
+        variant_count = int(result.stdout)
         
         # Conta amostras
         result = subprocess.run([
-            "bcftools", "query", "-l", vcf_file, "|", "wc", "-l"
-        ], shell=True, capture_output=True, text=True, check=True)
+            "bcftools", "query", "-l", vcf_file
+        ], capture_output=True, check=True)
         
-        sample_count = result.stdout.strip()
+        sample_count = result.stdout.count(b"\n")
         
         file_size = os.path.getsize(vcf_file) / (1024 * 1024)  # MB
         
@@ -325,7 +638,7 @@ def get_vcf_stats(vcf_file):
         print(f"  Amostras: {sample_count}")
         print(f"  Tamanho: {file_size:.2f} MB")
         
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, ValueError):
         print("Não foi possível obter estatísticas do arquivo final")
 
 def main():
@@ -334,9 +647,10 @@ def main():
     # Aumenta limites de arquivos
     file_limit = increase_file_limits()
     
-    # Ajusta tamanho do lote baseado no limite de arquivos
+    # Ajusta tamanho do lote baseado no limite de arquivos: com o limite
+    # alto, todas as regiões cabem num único concat (sem fase de lotes)
     global BATCH_SIZE
-    BATCH_SIZE = min(BATCH_SIZE, file_limit // 2)
+    BATCH_SIZE = max(min(BATCH_SIZE, file_limit // 2), file_limit - FD_RESERVE)
     print(f"Tamanho do lote ajustado para: {BATCH_SIZE}")
     
     os.makedirs(OUTPUT_DIR, exist_ok=True)
@@ -348,8 +662,11 @@ def main():
         print("Erro: Nenhuma região válida encontrada no arquivo BED!")
         return
     
+    # Agrupa regiões pequenas consecutivas: um freebayes por bloco
+    jobs = bin_regions(regions)
+    
     # Verifica VCFs existentes
-    existing_vcfs, missing_regions = check_existing_vcfs(regions, OUTPUT_DIR)
+    existing_vcfs, missing_regions = check_existing_vcfs(jobs, OUTPUT_DIR)
     
     # Se há regiões faltantes, processa elas
     newly_created_vcfs = []
@@ -357,24 +674,37 @@ def main():
         print(f"\n🔧 Processando {len(missing_regions)} regiões faltantes com FreeBayes...")
         
         # Cria bamlist
-        bamlist_file = create_bamlist()
+        bamlist_file, bam_files = create_bamlist()
+        bam_count = len(bam_files)
+        
+        # --skip-coverage é a profundidade somada de todas as amostras
+        skip_coverage = MAX_COVERAGE_PER_SAMPLE * max(1, bam_count)
+        print(f"FreeBayes pulará sítios com cobertura total acima de {skip_coverage}")
         
         try:
             # Prepara argumentos apenas para regiões faltantes
-            args_list = [
-                (region, region_id, OUTPUT_DIR, bamlist_file, REFERENCE_GENOME)
-                for region, region_id in missing_regions
-            ]
+            # Mais trabalho primeiro (LPT): tamanho x densidade de leituras do
+            # cromossomo, assim as regiões pesadas não ficam para o final
+            density = chrom_read_density(bam_files)
+            default_density = sum(density.values()) / len(density) if density else 1.0
+            args_list = sorted(missing_regions,
+                               key=lambda r: region_weight(r, density, default_density),
+                               reverse=True)
             
             print(f"Iniciando processamento paralelo com {MAX_PARALLEL_JOBS} workers...")
             
             # Executa em paralelo
             failed_count = 0
             
-            with ProcessPoolExecutor(max_workers=MAX_PARALLEL_JOBS) as executor:
-                results = list(executor.map(run_freebayes_region, args_list))
+            # Threads bastam: o trabalho está todo no freebayes/bcftools, a
+            # thread só espera o pipe (sem um interpretador Python por job)
+            with ThreadPoolExecutor(max_workers=MAX_PARALLEL_JOBS, initializer=init_worker,
+                                    initargs=(OUTPUT_DIR, bamlist_file, REFERENCE_GENOME,
+                                              skip_coverage)) as executor:
+                futures = [executor.submit(run_freebayes_region, args) for args in args_list]
                 
-                for result in results:
+                for future in as_completed(futures):
+                    result = future.result()
                     if result is not None:
                         newly_created_vcfs.append(result)
                     else:
@@ -402,7 +732,12 @@ def main():
         
         # Concatena todos os VCFs
         final_vcf_path = os.path.join(OUTPUT_DIR, FINAL_VCF)
-        concatenate_vcfs_in_batches(all_vcfs, final_vcf_path)
+        # Regiões ordenadas e disjuntas: concat --naive já sai ordenado e sem
+        # repetições, sem norm -d. Senão (ou com FORCE_NORM) o concat usa
+        # --allow-overlaps --remove-duplicates e o norm -d roda no final
+        deduplicate = FORCE_NORM or not bed_regions_disjoint(regions)
+        concatenate_vcfs_in_batches(all_vcfs, final_vcf_path, BATCH_SIZE, deduplicate,
+                                    naive=not deduplicate)
         
         # Obtém estatísticas
         get_vcf_stats(final_vcf_path)
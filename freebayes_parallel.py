@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 """
 Script simplificado para executar FreeBayes em todos os BAMs de um diretório,
-usando regiões específicas de um arquivo BED, e concatenar os VCFs com bcftools.
+usando regiões específicas de um arquivo BED (uma execução por BAM com -t).
 """
 
 import os
 import sys
 import subprocess
 import glob
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # ============= CONFIGURAÇÕES PICAS =============
@@ -15,7 +17,9 @@ REF_FASTA = "/home/lab/Desktop/arq_joao/testes_freebayes_bams_marcel/REF/GRCh38_
 BAM_DIRECTORY = "/home/lab/Desktop/arq_joao/testes_freebayes_bams_marcel/BAMs_INDEX"
 BED_FILE = "/home/lab/Desktop/arq_joao/testes_freebayes_bams_marcel/BED/livia.bed"
 OUTPUT_DIR = "/home/lab/Desktop/arq_joao/testes_freebayes_bams_marcel/VCF_MERGED"
-KEEP_INTERMEDIATE = False  # TRUE PRA MANTER ARQ INTERMEDIARIO
+KEEP_INTERMEDIATE = False  # TRUE PRA MANTER O BED DE ALVOS GERADO
+MAX_PARALLEL_JOBS = 4  # BAMs processados ao mesmo tempo
+BGZIP_THREADS = 2  # Threads de compressão do bgzip por BAM
 # =====================================================
 
 def parse_bed_file(bed_file):
@@ -52,6 +56,19 @@ def parse_bed_file(bed_file):
     
     return regions
 
+def write_targets_bed(regions, targets_bed):
+    """
+    Grava as regiões válidas (chr:start-end) como BED limpo para o -t do FreeBayes
+    """
+    lines = []
+    for region in regions:
+        chrom, span = region.rsplit(':', 1)
+        start, end = span.split('-')
+        lines.append(f"{chrom}\t{start}\t{end}\n")
+    
+    with open(targets_bed, 'w') as f:
+        f.write("".join(lines))
+
 def find_bam_files(bam_directory):
     """
     Encontra todos os arquivos BAM em um diretório
@@ -65,62 +82,70 @@ def find_bam_files(bam_directory):
     
     return sorted(bam_files)
 
-def run_freebayes(ref_fasta, bam_file, region, output_vcf):
+def run_freebayes(ref_fasta, bam_file, targets_bed, output_vcf):
     """
-    Executa o FreeBayes para um BAM específico e região
+    Executa o FreeBayes para um BAM em todas as regiões do BED de alvos
+    
+    Uma única execução por BAM (-t) abre o BAM e o índice da referência uma
+    vez e percorre todas as regiões, em vez de um processo por região. A
+    saída passa direto pelo bgzip e é indexada com tabix no mesmo worker,
+    enquanto os outros BAMs ainda rodam; o VCF em texto não vai para o disco.
     """
     cmd = [
         'freebayes',
         '-f', ref_fasta,
-        '-r', region,
+        '-t', targets_bed,
         bam_file
     ]
     
-    print(f"Executando: {' '.join(cmd)} > {output_vcf}")
+    print(f"Executando: {' '.join(cmd)} | bgzip > {output_vcf}")
     
     try:
-        with open(output_vcf, 'w') as outfile:
-            result = subprocess.run(cmd, stdout=outfile, stderr=subprocess.PIPE, 
-                                  text=True, check=True)
+        # stderr do freebayes em arquivo temporário: um PIPE não lido
+        # travaria o freebayes se ele escrevesse muito
+        with open(output_vcf, 'wb') as outfile, tempfile.TemporaryFile() as freebayes_log:
+            freebayes = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=freebayes_log)
+            try:
+                bgzip = subprocess.run(['bgzip', '-@', str(BGZIP_THREADS), '-c'],
+                                       stdin=freebayes.stdout, stdout=outfile,
+                                       stderr=subprocess.PIPE, text=True)
+            finally:
+                freebayes.stdout.close()
+                freebayes.wait()
+            freebayes_log.seek(0)
+            freebayes_err = freebayes_log.read().decode(errors='replace')
+        
+        if freebayes.returncode != 0:
+            raise subprocess.CalledProcessError(freebayes.returncode, cmd, stderr=freebayes_err)
+        if bgzip.returncode != 0:
+            raise subprocess.CalledProcessError(bgzip.returncode, bgzip.args, stderr=bgzip.stderr)
+        
+        subprocess.run(['tabix', '-f', '-p', 'vcf', output_vcf],
+                       stderr=subprocess.PIPE, text=True, check=True)
         return True
     except subprocess.CalledProcessError as e:
         print(f"Erro ao executar FreeBayes: {e}")
         print(f"Stderr: {e.stderr}")
         return False
     except FileNotFoundError:
-        print("Erro: FreeBayes não encontrado. Certifique-se de que está instalado e no PATH.")
+        print("Erro: FreeBayes, bgzip ou tabix não encontrado. Certifique-se de que estão instalados e no PATH.")
         return False
 
-def concatenate_with_bcftools(vcf_files, output_vcf):
+def process_bam(bam_file, targets_bed, output_dir):
     """
-    Concatena múltiplos arquivos VCF usando bcftools concat
+    Roda o FreeBayes de um BAM e devolve o caminho do VCF (None se falhar)
     """
-    print(f"Concatenando {len(vcf_files)} arquivos VCF usando bcftools concat...")
-    
-    # Filtrar apenas arquivos que existem e não estão vazios
-    valid_vcfs = []
-    for vcf in vcf_files:
-        if os.path.exists(vcf) and os.path.getsize(vcf) > 0:
-            valid_vcfs.append(vcf)
-    
-    if not valid_vcfs:
-        print("Nenhum arquivo VCF válido para concatenar")
-        return False
+    bam_name = Path(bam_file).stem
+    final_vcf = output_dir / f"{bam_name}_merged.vcf.gz"
+    print(f"\nProcessando BAM: {bam_name}")
     
-    cmd = ['bcftools', 'concat'] + valid_vcfs + ['-O', 'v', '-o', output_vcf]
+    success = run_freebayes(REF_FASTA, bam_file, str(targets_bed), str(final_vcf))
     
-    try:
-        print(f"Executando: {' '.join(cmd)}")
-        result = subprocess.run(cmd, stderr=subprocess.PIPE, text=True, check=True)
-        print(f"Concatenação concluída: {output_vcf}")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Erro ao executar bcftools concat: {e}")
-        print(f"Stderr: {e.stderr}")
-        return False
-    except FileNotFoundError:
-        print("Erro: bcftools não encontrado. Certifique-se de que está instalado e no PATH.")
-        return False
+    if success and final_vcf.exists() and final_vcf.stat().st_size > 0:
+        print(f"VCF criado para {bam_name}: {final_vcf}")
+        return str(final_vcf)
+    print(f"Nenhum VCF válido gerado para amostra {bam_name}")
+    return None
 
 def main():
     # Verificar se arquivos e diretórios existem
@@ -150,67 +175,29 @@ def main():
     bam_files = find_bam_files(BAM_DIRECTORY)
     print(f"Encontrados {len(bam_files)} arquivos BAM")
     
-    # Dicionário para armazenar VCFs por amostra
-    sample_vcf_files = {}
+    # BED de alvos só com as regiões válidas (linhas inválidas já avisadas)
+    targets_bed = output_dir / "targets.bed"
+    write_targets_bed(regions, str(targets_bed))
     
-    # Executar FreeBayes para cada combinação BAM x região
-    total_jobs = len(bam_files) * len(regions)
-    current_job = 0
+    # Executar FreeBayes uma vez por BAM, com todas as regiões de uma vez,
+    # vários BAMs em paralelo (threads: o trabalho é todo do FreeBayes)
+    print(f"Executando FreeBayes em {len(regions)} regiões, {MAX_PARALLEL_JOBS} BAMs por vez...")
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_JOBS) as executor:
+        futures = [executor.submit(process_bam, bam_file, targets_bed, output_dir)
+                   for bam_file in bam_files]
+        final_vcfs = [vcf for vcf in (future.result() for future in futures) if vcf]
     
-    for bam_file in bam_files:
-        bam_name = Path(bam_file).stem
-        sample_vcf_files[bam_name] = []
-        
-        for i, region in enumerate(regions):
-            current_job += 1
-            print(f"\nProcessando job {current_job}/{total_jobs}")
-            print(f"BAM: {bam_name}, Região: {region}")
-            
-            # Nome do arquivo VCF de saída
-            region_safe = region.replace(':', '_').replace('-', '_')
-            output_vcf = output_dir / f"{bam_name}_{region_safe}.vcf"
-            
-            # Executar FreeBayes
-            success = run_freebayes(REF_FASTA, bam_file, region, str(output_vcf))
-            
-            if success and output_vcf.exists() and output_vcf.stat().st_size > 0:
-                sample_vcf_files[bam_name].append(str(output_vcf))
-            else:
-                print(f"Aviso: Falha ou arquivo vazio para {output_vcf}")
-    
-    # Concatenar VCFs para cada amostra usando bcftools
-    final_vcfs = []
-    for bam_name, vcf_files in sample_vcf_files.items():
-        if vcf_files:
-            final_vcf = output_dir / f"{bam_name}_merged.vcf"
-            print(f"\nConcatenando {len(vcf_files)} regiões para amostra {bam_name}...")
-            success = concatenate_with_bcftools(vcf_files, str(final_vcf))
-            
-            if success:
-                final_vcfs.append(str(final_vcf))
-                print(f"VCF criado para {bam_name}: {final_vcf}")
-            else:
-                print(f"Erro na concatenação dos VCFs para {bam_name}")
-        else:
-            print(f"Nenhum VCF válido gerado para amostra {bam_name}")
+    if not KEEP_INTERMEDIATE:
+        try:
+            os.remove(targets_bed)
+        except OSError:
+            pass
     
     if final_vcfs:
         print(f"\nProcesso concluído!")
         print(f"VCFs finais criados: {len(final_vcfs)}")
         for vcf in final_vcfs:
             print(f"  - {vcf}")
-        
-        if not KEEP_INTERMEDIATE:
-            print("\nRemoção de arquivos intermediários...")
-            for sample_vcfs in sample_vcf_files.values():
-                for vcf_file in sample_vcfs:
-                    try:
-                        os.remove(vcf_file)
-                    except OSError:
-                        pass
-            print("Arquivos intermediários removidos")
-        else:
-            print(f"Arquivos VCF intermediários mantidos em: {output_dir}")
     else:
         print("Nenhum arquivo VCF final foi gerado com sucesso")
 
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 """
-Script para filtrar VCFs usando arquivo BED e fazer merge por cromossomo
+Script para fazer merge de VCFs por cromossomo, filtrando pelas regiões de um arquivo BED
 Requisitos: bcftools instalado no sistema
 """
 
@@ -8,6 +8,7 @@ import os
 import sys
 import subprocess
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 
@@ -24,41 +25,25 @@ def check_bcftools():
         return False
 
 
-def filter_vcf(vcf_file, bed_file, output_file):
+def merge_vcfs(vcf1, vcf2, bed_file, output_file, threads=1):
     """
-    Filtra um arquivo VCF usando um arquivo BED
+    Faz merge de dois arquivos VCF, só nas regiões do BED
     
-    Args:
-        vcf_file: Caminho para o arquivo VCF de entrada
-        bed_file: Caminho para o arquivo BED com regiões
-        output_file: Caminho para o arquivo VCF filtrado
-    """
-    cmd = [
-        'bcftools', 'view',
-        '-R', bed_file,  # Filtrar por regiões do BED
-        '-O', 'z',       # Output comprimido (vcf.gz)
-        '-o', output_file,
-        vcf_file
-    ]
-    
-    print(f"  Filtrando {os.path.basename(vcf_file)}...")
-    subprocess.run(cmd, check=True)
-    
-    # Indexar o arquivo filtrado
-    subprocess.run(['bcftools', 'index', '-t', output_file], check=True)
-
-
-def merge_vcfs(vcf1, vcf2, output_file):
-    """
-    Faz merge de dois arquivos VCF
+    O filtro por regiões (-R) é feito na própria passada do merge: sem os
+    VCFs filtrados intermediários, cada entrada é descomprimida uma vez e
+    só a saída é comprimida e indexada.
     
     Args:
-        vcf1: Primeiro arquivo VCF
-        vcf2: Segundo arquivo VCF
+        vcf1: Primeiro arquivo VCF (indexado)
+        vcf2: Segundo arquivo VCF (indexado)
+        bed_file: Caminho para o arquivo BED com regiões
         output_file: Arquivo VCF de saída
+        threads: Threads de (de)compressão do bcftools
     """
     cmd = [
         'bcftools', 'merge',
+        '--threads', str(threads),
+        '-R', bed_file,  # Filtrar por regiões do BED
         '-O', 'z',       # Output comprimido
         '-o', output_file,
         vcf1, vcf2
@@ -68,13 +53,13 @@ def merge_vcfs(vcf1, vcf2, output_file):
     subprocess.run(cmd, check=True)
     
     # Indexar o arquivo final
-    subprocess.run(['bcftools', 'index', '-t', output_file], check=True)
+    subprocess.run(['bcftools', 'index', '--threads', str(threads), '-t', output_file], check=True)
 
 
-def process_chromosome(chr_num, dir1, dir2, bed_file, output_dir, temp_dir, 
-                       pattern1="chr{}.vcf.gz", pattern2="chr{}.vcf.gz"):
+def process_chromosome(chr_num, dir1, dir2, bed_file, output_dir,
+                       pattern1="chr{}.vcf.gz", pattern2="chr{}.vcf.gz", threads=1):
     """
-    Processa um cromossomo: filtra ambos VCFs e faz merge
+    Processa um cromossomo: merge dos dois VCFs filtrado pelo BED
     
     Args:
         chr_num: Número do cromossomo
@@ -82,9 +67,9 @@ def process_chromosome(chr_num, dir1, dir2, bed_file, output_dir, temp_dir,
         dir2: Diretório 2 com VCFs
         bed_file: Arquivo BED para filtro
         output_dir: Diretório de saída
-        temp_dir: Diretório temporário
         pattern1: Padrão do nome dos arquivos VCF do diretório 1
         pattern2: Padrão do nome dos arquivos VCF do diretório 2
+        threads: Threads de (de)compressão de cada chamada do bcftools
     """
     print(f"\nProcessando cromossomo {chr_num}...")
     
@@ -100,20 +85,12 @@ def process_chromosome(chr_num, dir1, dir2, bed_file, output_dir, temp_dir,
         print(f"  AVISO: {vcf2_input} não encontrado. Pulando...")
         return False
     
-    # Arquivos temporários filtrados
-    vcf1_filtered = os.path.join(temp_dir, f"chr{chr_num}_dir1_filtered.vcf.gz")
-    vcf2_filtered = os.path.join(temp_dir, f"chr{chr_num}_dir2_filtered.vcf.gz")
-    
     # Arquivo de saída final
     output_file = os.path.join(output_dir, f"chr{chr_num}.merged.vcf.gz")
     
     try:
-        # Filtrar ambos os VCFs
-        filter_vcf(vcf1_input, bed_file, vcf1_filtered)
-        filter_vcf(vcf2_input, bed_file, vcf2_filtered)
-        
-        # Fazer merge
-        merge_vcfs(vcf1_filtered, vcf2_filtered, output_file)
+        # Merge já filtrando pelas regiões do BED
+        merge_vcfs(vcf1_input, vcf2_input, bed_file, output_file, threads)
         
         print(f"  ✓ Cromossomo {chr_num} concluído!")
         return True
@@ -121,13 +98,6 @@ def process_chromosome(chr_num, dir1, dir2, bed_file, output_dir, temp_dir,
     except subprocess.CalledProcessError as e:
         print(f"  ERRO ao processar cromossomo {chr_num}: {e}")
         return False
-    
-    finally:
-        # Limpar arquivos temporários
-        for temp_file in [vcf1_filtered, vcf2_filtered, 
-                         f"{vcf1_filtered}.tbi", f"{vcf2_filtered}.tbi"]:
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
 
 
 def main():
@@ -142,8 +112,6 @@ def main():
                        help='Arquivo BED com regiões para filtro')
     parser.add_argument('--output', required=True, 
                        help='Diretório de saída (será criado se não existir)')
-    parser.add_argument('--temp', default='./temp_vcf', 
-                       help='Diretório temporário (padrão: ./temp_vcf)')
     parser.add_argument('--pattern1', 
                        default='1kGP_high_coverage_Illumina.chr{}.filtered.SNV_INDEL_SV_phased_panel.vcf.gz',
                        help='Padrão do nome dos VCFs do diretório 1')
@@ -152,6 +120,10 @@ def main():
                        help='Padrão do nome dos VCFs do diretório 2')
     parser.add_argument('--chromosomes', default='1-22',
                        help='Cromossomos a processar (padrão: 1-22)')
+    parser.add_argument('--jobs', type=int, default=min(22, os.cpu_count() or 1),
+                       help='Cromossomos processados em paralelo (padrão: nº de CPUs, até 22)')
+    parser.add_argument('--threads', type=int, default=2,
+                       help='Threads do bcftools por chamada (padrão: 2)')
     
     args = parser.parse_args()
     
@@ -170,9 +142,8 @@ def main():
         print(f"ERRO: Arquivo BED não encontrado: {args.bed}")
         sys.exit(1)
     
-    # Criar diretórios de saída e temporário
+    # Criar diretório de saída
     os.makedirs(args.output, exist_ok=True)
-    os.makedirs(args.temp, exist_ok=True)
     
     # Processar cromossomos
     chromosomes = range(1, 23)  # 1 a 22
@@ -189,12 +160,18 @@ def main():
     success_count = 0
     fail_count = 0
     
-    for chr_num in chromosomes:
-        if process_chromosome(chr_num, args.dir1, args.dir2, args.bed, 
-                             args.output, args.temp, args.pattern1, args.pattern2):
-            success_count += 1
-        else:
-            fail_count += 1
+    # Cromossomos em paralelo: o trabalho é todo do bcftools, as threads só
+    # esperam os subprocessos
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        futures = [executor.submit(process_chromosome, chr_num, args.dir1, args.dir2, args.bed,
+                                   args.output, args.pattern1, args.pattern2,
+                                   args.threads)
+                   for chr_num in chromosomes]
+        for future in as_completed(futures):
+            if future.result():
+                success_count += 1
+            else:
+                fail_count += 1
     
     print("\n" + "="*60)
     print("RESUMO")
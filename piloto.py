@@ -1,33 +1,32 @@
 #!/usr/bin/env python3
 import os
 import argparse
-from collections import Counter
-import itertools
 import math
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
 import numpy as np
 import pandas as pd
 
+# Base do hash rolante das janelas (ímpar e grande: espalha bem os bytes)
+HASH_BASE = 1_000_003
+
+# Janelas por tarefa enviada aos workers
+WINDOW_CHUNK = 500
+
 # ---------------------------
 # Função para ler FASTA (pares de haplótipos)
 # ---------------------------
 def parse_fasta_pairs(path):
+    # Leitura em bloco e divisão por registro em C (split/translate), sem
+    # criar um objeto Python por linha do arquivo
+    with open(path, "rb") as fh:
+        data = fh.read()
     records = {}
-    cur_header = None
-    cur_seq = []
-    with open(path) as fh:
-        for line in fh:
-            line = line.strip()
-            if not line:
-                continue
-            if line.startswith(">"):
-                if cur_header is not None:
-                    records[cur_header] = "".join(cur_seq)
-                cur_header = line[1:].strip()
-                cur_seq = []
-            else:
-                cur_seq.append(line.strip())
-        if cur_header is not None:
-            records[cur_header] = "".join(cur_seq)
+    first = data.find(b">")
+    if first != -1:
+        for chunk in data[first+1:].split(b"\n>"):
+            header, _, seq = chunk.partition(b"\n")
+            records[header.decode().strip()] = seq.translate(None, b" \t\r\n").decode()
 
     samples = {}
     for hdr, seq in records.items():
@@ -52,136 +51,180 @@ def parse_fasta_pairs(path):
 # ---------------------------
 # Funções de estatísticas genéticas (sem HW/LD)
 # ---------------------------
-def heterozygosity_expected(freqs):
-    ps = np.array(list(freqs.values()))
+# (ps: array NumPy com as frequências dos alelos da janela, montado uma vez
+#  por janela e compartilhado por todas as métricas)
+def heterozygosity_expected(ps):
     return float(1.0 - np.sum(ps * ps))
 
 def heterozygosity_observed(genotypes):
+    # genotypes: array (n, 2) com os IDs dos dois alelos de cada indivíduo
     n = len(genotypes)
     if n == 0:
         return np.nan
-    het = sum(1 for (a1, a2) in genotypes if a1 != a2)
-    return het / n
+    return float(np.count_nonzero(genotypes[:, 0] != genotypes[:, 1]) / n)
 
-def effective_number_of_alleles(freqs):
-    ps = np.array(list(freqs.values()))
+def effective_number_of_alleles(ps):
     s = np.sum(ps * ps)
     return float(1.0 / s) if s > 0 else np.nan
 
-def pic_from_freqs(freqs):
-    ps = list(freqs.values())
-    s1 = sum(p*p for p in ps)
-    s2 = sum(2*(ps[i]**2)*(ps[j]**2) for i in range(len(ps)) for j in range(i+1,len(ps)))
+def pic_from_freqs(ps):
+    p2 = ps * ps
+    s1 = np.sum(p2)
+    # sum_{i<j} 2*pi²*pj² = (sum pi²)² - sum pi⁴, sem o laço duplo O(A²)
+    s2 = s1 * s1 - np.sum(p2 * p2)
     return float(1.0 - s1 - s2)
 
-def genotype_frequencies_under_hwe(freqs):
-    alleles = sorted(freqs.keys())
-    gf = {}
-    for i, a in enumerate(alleles):
-        gf[(a,a)] = freqs[a]*freqs[a]
-        for j in range(i+1,len(alleles)):
-            b = alleles[j]
-            gf[(a,b)] = 2*freqs[a]*freqs[b]
-    return gf
-
-def match_probability_from_freqs(freqs):
-    gf = genotype_frequencies_under_hwe(freqs)
-    return float(sum(v*v for v in gf.values()))
-
-def probability_all_different(freqs, m):
-    alleles = list(freqs.keys())
-    if m > len(alleles):
+def match_probability_from_freqs(ps):
+    # Soma dos quadrados das frequências genotípicas em HWE, sem montar os
+    # A(A+1)/2 genótipos: sum pi⁴ + sum_{i<j} (2*pi*pj)² = 2*(sum pi²)² - sum pi⁴
+    p2 = ps * ps
+    s2 = np.sum(p2)
+    return float(2.0 * s2 * s2 - np.sum(p2 * p2))
+
+def probability_all_different(ps, m):
+    ps = ps.tolist()  # laço escalar: floats do Python são mais rápidos aqui
+    if m > len(ps):
         return 0.0
-    total = 0.0
-    for combo in itertools.combinations(alleles, m):
-        prod = 1.0
-        for a in combo:
-            prod *= freqs[a]
-        total += prod
-    from math import factorial
-    return float(factorial(m)*total)
+    # Soma dos produtos de todas as combinações de m alelos = polinômio
+    # simétrico elementar e_m, acumulado em O(A*m) em vez de C(A, m) tuplas
+    e = [1.0] + [0.0]*m
+    for p in ps:
+        for k in range(m, 0, -1):
+            e[k] += p * e[k-1]
+    return float(math.factorial(m)*e[m])
 
 # ---------------------------
 # Função otimizada: diversidade de alelos em combinações de indivíduos (amostragem)
 # ---------------------------
-def allele_diversity_combinations(genotypes_dict, n_individuals=2, n_samples=5000, seed=42):
+def sample_groups(N, sizes=(2, 3, 4), n_samples=5000, seed=42):
+    """
+    Sorteia n_samples grupos de indivíduos (sem reposição) entre N amostras.
+    Retorna array (n_samples, max_n) com os índices, ou None se nenhum
+    tamanho em sizes couber em N. Depende só de N e dos parâmetros, então
+    pode ser sorteado uma vez e reaproveitado em todas as janelas.
+    """
+    rng = np.random.default_rng(seed)
+    max_n = max((n for n in sizes if n <= N), default=0)
+    if max_n == 0:
+        return None
+    # Prefixo de uma permutação aleatória por linha = grupo sem reposição
+    return np.argsort(rng.random((n_samples, N)), axis=1)[:, :max_n]
+
+def allele_diversity_combinations(genotypes_dict, sizes=(2, 3, 4), n_samples=5000, seed=42, groups=None):
     """
     Estima a % de combinações de indivíduos com 1..2*n alelos diferentes.
     Usa amostragem aleatória em vez de todas as combinações => rápido e leve.
+    Um único sorteio de n_samples grupos (sem reposição) serve a todos os
+    tamanhos n em sizes: os primeiros n indivíduos de cada grupo. groups
+    (de sample_groups) evita refazer o sorteio a cada chamada. Retorna
+    {n: {"diff_1": ..., ...}} ({} para n maior que o número de amostras).
     """
-    rng = np.random.default_rng(seed)
-    samples = list(genotypes_dict.keys())
-    N = len(samples)
-    if N < n_individuals:
-        return {}
-
-    counts = Counter()
-    total = 0
-    for _ in range(n_samples):
-        chosen = rng.choice(samples, size=n_individuals, replace=False)
-        alleles = set()
-        for s in chosen:
-            alleles.update(genotypes_dict[s])
-        counts[len(alleles)] += 1
-        total += 1
-
-    result = {f"diff_{i}": counts[i]/total for i in range(1, 2*n_individuals+1)}
-    return result
+    G = np.array(list(genotypes_dict.values()))
+    N = len(G)
+    chosen = groups if groups is not None else sample_groups(N, sizes, n_samples, seed)
+    if chosen is None:
+        return {n: {} for n in sizes}
+    n_samples = len(chosen)
+
+    results = {}
+    for n in sizes:
+        if n > N:
+            results[n] = {}
+            continue
+        alleles = np.sort(G[chosen[:, :n]].reshape(n_samples, 2*n), axis=1)
+        n_diff = (np.diff(alleles, axis=1) != 0).sum(axis=1) + 1
+        counts = np.bincount(n_diff, minlength=2*n+1)
+        results[n] = {f"diff_{i}": counts[i]/n_samples for i in range(1, 2*n+1)}
+    return results
 
 # ---------------------------
 # Loop principal de janelas
 # ---------------------------
-def process_windows(samples, window_size, outdir):
-    os.makedirs(outdir, exist_ok=True)
-    sum_dir = os.path.join(outdir,"summaries")
-    os.makedirs(sum_dir, exist_ok=True)
-    allele_dir = os.path.join(outdir,"alleles")
-    os.makedirs(allele_dir, exist_ok=True)
+# Parâmetros das janelas, definidos uma vez por worker (matriz de haplótipos
+# anexada da memória compartilhada, sem uma cópia por processo)
+_window_data = {}
 
-    lengths = [min(len(h1), len(h2)) for h1,h2 in samples.values()]
-    if not lengths:
-        raise ValueError("Nenhuma sequência válida encontrada.")
-    L = min(lengths)
+def _init_window_worker(shm_name, shape, names, window_size):
+    shm = SharedMemory(name=shm_name)
+    H = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    _window_data.update(shm=shm, H=H, names=names, window_size=window_size)
+
+def process_window_range(start_lo, start_hi):
+    """
+    Processa as janelas que começam em start_lo..start_hi-1.
+    Retorna (linhas do resumo, texto do TSV de alelos, mensagens de log).
+    """
+    H = _window_data["H"]
+    names = _window_data["names"]
+    window_size = _window_data["window_size"]
+    total = H.shape[0]
 
-    results=[]
-    for start in range(0,L-window_size+1):
+    # Hash polinomial rolante (mod 2**64, overflow natural do uint64) de cada
+    # haplótipo na janela: deslizar uma posição custa O(1) por haplótipo.
+    # Cada intervalo começa o seu hash do zero, então os intervalos são
+    # independentes entre si
+    base = np.uint64(HASH_BASE)
+    pow_b = np.uint64(pow(HASH_BASE, window_size - 1, 2**64))
+    H64 = H[:, start_lo:start_hi+window_size-1].astype(np.uint64)
+    hashes = np.zeros(total, dtype=np.uint64)
+    for k in range(window_size):
+        hashes = hashes * base + H64[:, k]
+
+    # Sorteio da diversidade: mesmo N e mesma semente em todas as janelas,
+    # então é feito uma vez só (antes era refeito a cada janela)
+    groups = sample_groups(len(names), sizes=(2, 3, 4), n_samples=1000)
+
+    rows, allele_lines, logs = [], [], []
+    for start in range(start_lo, start_hi):
         end = start+window_size
-        genotypes={}
-        alleles_pool=[]
-        for s,(h1,h2) in samples.items():
-            a1=h1[start:end]
-            a2=h2[start:end]
-            genotypes[s]=(a1,a2)
-            alleles_pool.extend([a1,a2])
-        allele_counter = Counter(alleles_pool)
-        total = sum(allele_counter.values())
-        freqs = {a: allele_counter[a]/total for a in allele_counter}
-        num_alleles = len(freqs)
-        mapping = {allele:f"A{i+1}" for i,allele in enumerate(freqs.keys())}
-        allele_freqs_str = ", ".join([f"{mapping[a]}({freqs[a]:.6f})" for a in sorted(freqs,key=freqs.get,reverse=True)])
-
-        # salva alelos
-        allele_out = os.path.join(allele_dir,f"window_{start+1}_{end}_alleles.tsv")
-        with open(allele_out,"w") as fh:
-            fh.write("Allele\tRenamed\tFrequency\n")
-            for orig,renamed in mapping.items():
-                fh.write(f"{orig}\t{renamed}\t{freqs[orig]:.6f}\n")
-
-        genotype_list = list(genotypes.values())
-        He = heterozygosity_expected(freqs)
-        Ho = heterozygosity_observed(genotype_list)
-        Ae = effective_number_of_alleles(freqs)
-        PIC = pic_from_freqs(freqs)
-        MP = match_probability_from_freqs(freqs)
+        if start > start_lo:
+            j = start - start_lo
+            hashes = (hashes - H64[:, j-1] * pow_b) * base + H64[:, j+window_size-1]
+        view = H[:, start:end]
+        _, first_idx, inverse, counts = np.unique(hashes, return_index=True,
+                                                  return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+        # Colisão de hash (raríssima): confere cada haplótipo com o
+        # representante do seu hash e, se diferir, agrupa pelas sequências
+        if not np.array_equal(view, view[first_idx[inverse]]):
+            _, first_idx, inverse, counts = np.unique(view, axis=0, return_index=True,
+                                                      return_inverse=True, return_counts=True)
+            inverse = inverse.reshape(-1)
+        # IDs dos alelos na ordem de primeira aparição (como o Counter fazia)
+        order = np.argsort(first_idx)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        allele_ids = rank[inverse]
+        alleles = [view[first_idx[i]].tobytes().decode("latin-1") for i in order]
+        allele_counts = counts[order].tolist()
+
+        # Genótipos como pares de IDs: Ho e a diversidade só comparam alelos
+        genotype_ids = allele_ids.reshape(-1, 2)
+        genotypes = dict(zip(names, map(tuple, genotype_ids.tolist())))
+        ps = np.array(allele_counts) / total
+        num_alleles = len(alleles)
+
+        # Alelo i (ordem de aparição) vira A{i+1}; frequência formatada uma
+        # vez e reaproveitada no TSV de alelos e no resumo ordenado
+        freq_strs = [f"{p:.6f}" for p in ps.tolist()]
+        allele_lines.extend(f"{start+1}\t{end}\t{orig}\tA{i+1}\t{f}\n"
+                            for i, (orig, f) in enumerate(zip(alleles, freq_strs)))
+        by_freq = sorted(range(num_alleles), key=allele_counts.__getitem__, reverse=True)
+        allele_freqs_str = ", ".join([f"A{i+1}({freq_strs[i]})" for i in by_freq])
+
+        He = heterozygosity_expected(ps)
+        Ho = heterozygosity_observed(genotype_ids)
+        Ae = effective_number_of_alleles(ps)
+        PIC = pic_from_freqs(ps)
+        MP = match_probability_from_freqs(ps)
         PD = 1.0 - MP
-        prob_2_diff = probability_all_different(freqs,2)
-        prob_3_diff = probability_all_different(freqs,3)
-        prob_4_diff = probability_all_different(freqs,4)
+        prob_2_diff = probability_all_different(ps,2)
+        prob_3_diff = probability_all_different(ps,3)
+        prob_4_diff = probability_all_different(ps,4)
 
         # diversidade de alelos em combinações (amostragem)
-        diversity_2 = allele_diversity_combinations(genotypes, n_individuals=2, n_samples=1000)
-        diversity_3 = allele_diversity_combinations(genotypes, n_individuals=3, n_samples=1000)
-        diversity_4 = allele_diversity_combinations(genotypes, n_individuals=4, n_samples=1000)
+        diversity = allele_diversity_combinations(genotypes, sizes=(2, 3, 4), groups=groups)
+        diversity_2, diversity_3, diversity_4 = diversity[2], diversity[3], diversity[4]
 
         # Score (sem LD/HW)
         metrics = {"He":He,"Ho":Ho,"Ae":Ae/10 if Ae else 0,"PIC":PIC,"PD":PD,
@@ -189,7 +232,7 @@ def process_windows(samples, window_size, outdir):
         metrics = {k: float(np.clip(v,0,1)) for k,v in metrics.items() if not math.isnan(v)}
         score = np.mean(list(metrics.values()))
 
-        results.append({
+        rows.append({
             "start":start+1,"end":end,"num_alleles":num_alleles,"alleles_freqs":allele_freqs_str,
             "He":He,"Ho":Ho,"Ae":Ae,"PIC":PIC,
             "MP":MP,"PD":PD,"prob_2_diff":prob_2_diff,"prob_3_diff":prob_3_diff,"prob_4_diff":prob_4_diff,
@@ -199,9 +242,74 @@ def process_windows(samples, window_size, outdir):
             **{f"4ind_{k}":v for k,v in diversity_4.items()},
         })
 
-        print(f"[OK] Janela {start+1}-{end} processada. He={He:.6f}, Ho={Ho:.6f}, Ae={Ae:.6f}, PIC={PIC:.6f}")
+        logs.append(f"[OK] Janela {start+1}-{end} processada. He={He:.6f}, Ho={Ho:.6f}, Ae={Ae:.6f}, PIC={PIC:.6f}")
+
+    return rows, "".join(allele_lines), logs
+
+def process_windows(samples, window_size, outdir, workers=1):
+    os.makedirs(outdir, exist_ok=True)
+    sum_dir = os.path.join(outdir,"summaries")
+    os.makedirs(sum_dir, exist_ok=True)
+    allele_dir = os.path.join(outdir,"alleles")
+    os.makedirs(allele_dir, exist_ok=True)
+
+    lengths = [min(len(h1), len(h2)) for h1,h2 in samples.values()]
+    if not lengths:
+        raise ValueError("Nenhuma sequência válida encontrada.")
+    L = min(lengths)
+
+    # Haplótipos como matriz uint8 (2 linhas por amostra: h1, h2); cada
+    # janela é uma fatia da matriz e os alelos saem do np.unique em C, sem
+    # fatiar strings amostra por amostra
+    names = list(samples.keys())
+    H = np.frombuffer("".join(h1[:L] + h2[:L] for h1, h2 in samples.values()).encode("latin-1"),
+                      dtype=np.uint8).reshape(2*len(names), L)
+
+    # Janelas são independentes: vão em blocos de WINDOW_CHUNK para os
+    # workers, que leem a matriz de uma memória compartilhada
+    starts = range(0, L-window_size+1, WINDOW_CHUNK)
+    ranges_lo = list(starts)
+    ranges_hi = [min(lo + WINDOW_CHUNK, L-window_size+1) for lo in ranges_lo]
+
+    shm = None
+    executor = None
+    try:
+        if workers > 1 and len(ranges_lo) > 1:
+            shm = SharedMemory(create=True, size=H.nbytes)
+            np.ndarray(H.shape, dtype=np.uint8, buffer=shm.buf)[:] = H
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_window_worker,
+                                           initargs=(shm.name, H.shape, names, window_size))
+            chunks = executor.map(process_window_range, ranges_lo, ranges_hi)
+        else:
+            _window_data.update(H=H, names=names, window_size=window_size)
+            chunks = map(process_window_range, ranges_lo, ranges_hi)
+
+        # Um arquivo de alelos só, aberto uma vez: antes era um TSV por janela
+        # (centenas de milhares de arquivos pequenos em sequências longas).
+        # O resumo também vai para o disco bloco a bloco, em vez de acumular
+        # um dict por janela na memória até o fim
+        allele_out = os.path.join(allele_dir,"windows_alleles.tsv")
+        unsorted_out = os.path.join(sum_dir,"all_windows_summary.unsorted.tsv")
+        with open(allele_out,"w") as allele_fh, open(unsorted_out,"w") as sum_fh:
+            allele_fh.write("Start\tEnd\tAllele\tRenamed\tFrequency\n")
+            header = True
+            # map devolve os blocos na ordem das janelas
+            for rows, allele_text, logs in chunks:
+                allele_fh.write(allele_text)
+                pd.DataFrame(rows).to_csv(sum_fh, sep="\t", index=False, header=header)
+                header = False
+                print("\n".join(logs))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
 
-    df = pd.DataFrame(results)
+    # Ordenação pelo Score: relê o TSV em colunas (arrays NumPy), bem mais
+    # compacto que a lista de dicts
+    df = pd.read_csv(unsorted_out, sep="\t", float_precision="round_trip")
+    os.remove(unsorted_out)
     df.sort_values("Score",ascending=False,inplace=True)
     df.to_csv(os.path.join(sum_dir,"all_windows_summary.tsv"),sep="\t",index=False)
     return df
@@ -214,19 +322,21 @@ def main():
     p.add_argument("--fasta", required=True)
     p.add_argument("--window", type=int, required=True)
     p.add_argument("--outdir", required=True)
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                   help="Processos para as janelas (padrão: nº de CPUs)")
     args = p.parse_args()
 
     samples = parse_fasta_pairs(args.fasta)
     print(f"Carregadas {len(samples)} amostras.")
     
-    df = process_windows(samples, args.window, args.outdir)
+    df = process_windows(samples, args.window, args.outdir, args.workers)
     
     print("\n"+"="*50)
     print("RESUMO DOS RESULTADOS:")
     print("="*50)
     print(f"Total de janelas processadas: {len(df)}")
     print(f"Arquivo principal salvo em: {os.path.join(args.outdir,'summaries','all_windows_summary.tsv')}")
-    print(f"Arquivos de alelos salvos em: {os.path.join(args.outdir,'alleles/')}")
+    print(f"Alelos das janelas salvos em: {os.path.join(args.outdir,'alleles','windows_alleles.tsv')}")
 
 if __name__=="__main__":
     main()
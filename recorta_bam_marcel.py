@@ -1,5 +1,7 @@
 import os
 import subprocess
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 
 # Caminhos base
 base_dir = ""
@@ -8,6 +10,10 @@ output_dir = os.path.join("/home/lab/Downloads", "BAMs_RECORTADOS")
 bed_path = os.path.join("/home/lab/Desktop/arq_joao/python/data/BEDs", "optimized.bed")
 amostras_path = os.path.join("/home/lab/Downloads", "amostras.txt")
 
+# Paralelismo: BAMs recortados ao mesmo tempo e threads de (des)compressão por samtools
+SAMTOOLS_THREADS = 4
+MAX_WORKERS = max(1, (os.cpu_count() or SAMTOOLS_THREADS) // SAMTOOLS_THREADS)
+
 # Garante que a pasta de saída exista
 os.makedirs(output_dir, exist_ok=True)
 
@@ -15,17 +21,24 @@ os.makedirs(output_dir, exist_ok=True)
 with open(amostras_path) as f:
     amostras = [linha.strip().lower() for linha in f if linha.strip()]
 
-for amostra in amostras:
+# Lista os BAMs uma vez só (nome em minúsculas → nome real), ordenados para
+# achar o prefixo da amostra por busca binária em vez de varrer a pasta
+with os.scandir(bam_dir) as entries:
+    bams = sorted((entry.name.lower(), entry.name) for entry in entries
+                  if entry.name.endswith(".bam"))
+bam_chaves = [chave for chave, _ in bams]
+
+def recortar(amostra):
+    """Recorta o BAM da amostra pelas regiões do BED."""
     # Busca o arquivo BAM correspondente
     bam_nome = None
-    for arquivo in os.listdir(bam_dir):
-        if arquivo.lower().startswith(amostra) and arquivo.endswith(".bam"):
-            bam_nome = arquivo
-            break
+    i = bisect_left(bam_chaves, amostra)
+    if i < len(bams) and bam_chaves[i].startswith(amostra):
+        bam_nome = bams[i][1]
 
     if not bam_nome:
         print(f"❌ BAM não encontrado para a amostra: {amostra}")
-        continue
+        return
 
     bam_path = os.path.join(bam_dir, bam_nome)
     bam_saida = os.path.join(output_dir, f"{amostra}_recortado.bam")
@@ -33,12 +46,17 @@ for amostra in amostras:
     # Comando samtools view -L
     cmd = [
         "samtools", "view", "-b",
+        "-@", str(SAMTOOLS_THREADS),
         "-L", bed_path,
         "-o", bam_saida,
         bam_path
     ]
-    print(f"Comando: samtools view -b -L {bed_path} -o {bam_saida} {bam_path}")
+    print(f"Comando: samtools view -b -@ {SAMTOOLS_THREADS} -L {bed_path} -o {bam_saida} {bam_path}")
     print(f"🔄 Processando {bam_nome} → {bam_saida}")
     subprocess.run(cmd)
 
+# Recorta os BAMs em paralelo (cada samtools lê um arquivo diferente)
+with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(amostras) or 1)) as executor:
+    list(executor.map(recortar, amostras))
+
 print("✅ Recorte de todos os BAMs concluído.")
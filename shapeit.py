@@ -2,17 +2,45 @@
 import os
 import subprocess
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 def run_cmd(cmd):
     print(f"\n>>> Rodando: {cmd}")
     subprocess.run(cmd, shell=True, check=True)
 
+def phase_chromosome(chr_num, vcf_bial, bial_dir, multi_dir, log_dir, threads):
+    """Faseia um cromossomo com SHAPEIT4 e converte de volta para multialélico."""
+    chrom_name = f"chr{chr_num}"  # Corrige o nome do cromossomo
+    print(f"\n=== Faseando {chrom_name} ===")
+
+    phased_vcf = os.path.join(bial_dir, f"{chrom_name}_phased.vcf.gz")  # salvar temporário na pasta biallelic
+    phased_log = os.path.join(log_dir, f"{chrom_name}_phased.log")
+
+    # Rodar SHAPEIT4 com parâmetros fixos
+    run_cmd(
+        f"shapeit4 "
+        f"--input {vcf_bial} "
+        f"--region {chrom_name} "
+        f"--output {phased_vcf} "
+        f"--thread {threads} "
+        f"--log {phased_log}"
+    )
+
+    # === Passo 3: Converter de volta para multialélico ===
+    phased_multi = os.path.join(multi_dir, f"{chrom_name}_phased_multial.vcf.gz")
+    run_cmd(f"bcftools norm -m+any {phased_vcf} -Oz -o {phased_multi}")
+    run_cmd(f"tabix -p vcf {phased_multi}")
+
 def main():
     parser = argparse.ArgumentParser(description="Pipeline SHAPEIT4 cromossomo por cromossomo com organização de pastas")
     parser.add_argument("--vcf", required=True, help="VCF de entrada (bgz + indexado)")
     parser.add_argument("--out_dir", required=True, help="Diretório de saída")
     parser.add_argument("--threads", default="4", help="Número de threads (default=4)")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Cromossomos faseados ao mesmo tempo (default=CPUs/threads)")
     args = parser.parse_args()
+    if args.jobs is None:
+        args.jobs = max(1, (os.cpu_count() or 1) // int(args.threads))
 
     # Criar diretórios
     os.makedirs(args.out_dir, exist_ok=True)
@@ -28,28 +56,14 @@ def main():
     run_cmd(f"bcftools norm -m-any {args.vcf} -Oz -o {vcf_bial}")
     run_cmd(f"tabix -p vcf {vcf_bial}")
 
-    # === Passo 2: Loop pelos cromossomos 1 a 22 ===
-    for chr_num in range(1, 23):
-        chrom_name = f"chr{chr_num}"  # Corrige o nome do cromossomo
-        print(f"\n=== Faseando {chrom_name} ===")
-
-        phased_vcf = os.path.join(bial_dir, f"{chrom_name}_phased.vcf.gz")  # salvar temporário na pasta biallelic
-        phased_log = os.path.join(log_dir, f"{chrom_name}_phased.log")
-
-        # Rodar SHAPEIT4 com parâmetros fixos
-        run_cmd(
-            f"shapeit4 "
-            f"--input {vcf_bial} "
-            f"--region {chrom_name} "
-            f"--output {phased_vcf} "
-            f"--thread {args.threads} "
-            f"--log {phased_log}"
-        )
-
-        # === Passo 3: Converter de volta para multialélico ===
-        phased_multi = os.path.join(multi_dir, f"{chrom_name}_phased_multial.vcf.gz")
-        run_cmd(f"bcftools norm -m+any {phased_vcf} -Oz -o {phased_multi}")
-        run_cmd(f"tabix -p vcf {phased_multi}")
+    # === Passo 2: Cromossomos 1 a 22 em paralelo (independentes entre si;
+    # cada um tem o seu log) ===
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(phase_chromosome, chr_num, vcf_bial, bial_dir,
+                                   multi_dir, log_dir, args.threads)
+                   for chr_num in range(1, 23)]
+        for future in futures:
+            future.result()
 
     print("\n✅ Pipeline finalizado com sucesso!")
     print(f"Bialélicos -> {bial_dir}")
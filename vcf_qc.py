@@ -1,31 +1,44 @@
 import os
 import subprocess
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
 
 # Caminhos
 vcf_dir = "/home/lab/Desktop/arq_joao/testes_freebayes_bams_marcel/VCF_MERGED"         # pasta com seus VCFs
 output_dir = "/home/lab/Desktop/arq_joao/testes_freebayes_bams_marcel/VCF_QC"  # pasta de saída
 ref_fa = "/home/lab/Desktop/arq_joao/testes_freebayes_bams_marcel/REF/GRCh38_full_analysis_set_plus_decoy_hla.fa"         # referência hg38.fa
 
+# VCFs processados ao mesmo tempo (cada um usa dois processos bcftools)
+MAX_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
 os.makedirs(output_dir, exist_ok=True)
 
 # Procurar arquivos .vcf na pasta
 vcf_files = glob(os.path.join(vcf_dir, "*.vcf"))
 
-for vcf in vcf_files:
+def process_one(vcf):
+    """Filtra QUAL<1 e normaliza um VCF, gravando direto em bgzip."""
     sample_name = os.path.basename(vcf).replace(".vcf", "")
-    output_file = os.path.join(output_dir, f"{sample_name}_filtrado_norm.vcf")
+    output_file = os.path.join(output_dir, f"{sample_name}_filtrado_norm.vcf.gz")
 
     print(f"[INFO] Processando {vcf} -> {output_file}")
 
-    # Pipeline: bcftools view -> bcftools norm
-    view_cmd = ["bcftools", "view", "--exclude", "QUAL<1", vcf]
-    norm_cmd = ["bcftools", "norm", "-f", ref_fa]
+    # Pipeline: bcftools view -> bcftools norm (BCF sem compressão entre os
+    # dois, VCF bgzipado na saída em vez de texto puro)
+    view_cmd = ["bcftools", "view", "--exclude", "QUAL<1", "-Ou", vcf]
+    norm_cmd = ["bcftools", "norm", "-f", ref_fa, "-Oz", "-o", output_file, "-"]
 
-    with open(output_file, "w") as out:
-        p1 = subprocess.Popen(view_cmd, stdout=subprocess.PIPE)
-        p2 = subprocess.Popen(norm_cmd, stdin=p1.stdout, stdout=out)
-        p1.stdout.close()  # permite p1 receber SIGPIPE se p2 morrer
-        p2.communicate()
+    p1 = subprocess.Popen(view_cmd, stdout=subprocess.PIPE)
+    p2 = subprocess.Popen(norm_cmd, stdin=p1.stdout)
+    p1.stdout.close()  # permite p1 receber SIGPIPE se p2 morrer
+    p2.communicate()
+    p1.wait()
 
+    if p1.returncode != 0 or p2.returncode != 0:
+        print(f"[ERRO] Falha ao processar {vcf}")
+        return
     print(f"[OK] Resultado salvo em {output_file}")
+
+# Cada VCF é independente: vários pipelines ao mesmo tempo
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    list(executor.map(process_one, vcf_files))
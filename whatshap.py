@@ -11,95 +11,197 @@ import sys
 from pathlib import Path
 import tempfile
 import shutil
-import glob
+import fnmatch
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
-def run_command(cmd, description=""):
-    """Executa comando e verifica se foi bem-sucedido"""
-    print(f"Executando: {description}")
-    print(f"Comando: {' '.join(cmd)}")
+# Detalhes de cada comando (só com -v/--verbose)
+log = logging.getLogger("whatshap_pipeline")
+
+def run_command(cmd, description="", capture_stdout=False, log_path=None):
+    """Executa comando e verifica se foi bem-sucedido (levanta RuntimeError se falhar)"""
+    log.debug("Executando: %s", description)
+    log.debug("Comando: %s", cmd)
     
-    try:
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-        print(f"✓ Sucesso: {description}")
-        return result
-    except subprocess.CalledProcessError as e:
-        print(f"✗ Erro em: {description}")
-        print(f"Comando falhou: {' '.join(cmd)}")
-        print(f"Stderr: {e.stderr}")
-        sys.exit(1)
+    # stderr vai para um arquivo (log da etapa ou temporário) em vez de ficar
+    # acumulado na memória; só é lido se o comando falhar. stdout só é
+    # capturado quando a saída é usada (ex.: lista de amostras)
+    with (open(log_path, "wb") if log_path else tempfile.TemporaryFile()) as err:
+        try:
+            result = subprocess.run(cmd, check=True, stderr=err,
+                                    stdout=subprocess.PIPE if capture_stdout else None)
+            log.debug("✓ Sucesso: %s", description)
+            return result
+        except subprocess.CalledProcessError as e:
+            print(f"✗ Erro em: {description}")
+            print(f"Comando falhou: {' '.join(cmd)}")
+            if log_path:
+                print(f"Stderr: veja {log_path}")
+            else:
+                err.seek(0)
+                print(f"Stderr: {err.read().decode(errors='replace')}")
+            # Exceção em vez de sys.exit: chega ao main também a partir das threads
+            raise RuntimeError(f"Falha em: {description}") from e
 
 def get_samples_from_vcf(vcf_file):
     """Extrai nomes das amostras do arquivo VCF"""
     print(f"Extraindo amostras de: {vcf_file}")
     
     cmd = ["bcftools", "query", "-l", vcf_file]
-    result = run_command(cmd, "Extraindo lista de amostras")
+    result = run_command(cmd, "Extraindo lista de amostras", capture_stdout=True)
     
-    samples = result.stdout.strip().split('\n')
+    samples = result.stdout.decode().strip().split('\n')
     samples = [s for s in samples if s]  # Remove linhas vazias
     
     print(f"Encontradas {len(samples)} amostras: {', '.join(samples)}")
     return samples
 
-def find_bam_for_sample(sample, bam_dir):
-    """Encontra o arquivo BAM correspondente à amostra no diretório"""
-    # Padrões possíveis para nomes de arquivos BAM
-    patterns = [
-        f"{sample}.bam",
-        f"{sample}*.bam",
-        f"*{sample}.bam",
-        f"*{sample}*.bam"
-    ]
-    
-    for pattern in patterns:
-        bam_path = os.path.join(bam_dir, pattern)
-        matches = glob.glob(bam_path)
-        if matches:
-            # Retorna o primeiro match encontrado
-            bam_file = matches[0]
-            print(f"BAM encontrado para amostra {sample}: {bam_file}")
-            return bam_file
-    
-    # Se não encontrou, tenta buscar recursivamente
+def build_bam_index(bam_dir, samples):
+    """Encontra o arquivo BAM de cada amostra varrendo o diretório uma vez só"""
+    # Lista os BAMs uma vez (nível de cima separado, para os padrões, e
+    # todos os subdiretórios para a busca recursiva), em vez de 4 globs +
+    # um os.walk inteiro por amostra
+    top_bams = []
+    all_bams = []
     for root, dirs, files in os.walk(bam_dir):
         for file in files:
             if file.endswith('.bam'):
+                all_bams.append((file, os.path.join(root, file)))
+                if root == bam_dir and not file.startswith('.'):  # glob ignora ocultos
+                    top_bams.append(file)
+    
+    sample_bams = {}
+    for sample in samples:
+        # Padrões possíveis para nomes de arquivos BAM
+        patterns = [
+            f"{sample}.bam",
+            f"{sample}*.bam",
+            f"*{sample}.bam",
+            f"*{sample}*.bam"
+        ]
+        
+        bam_file = None
+        for pattern in patterns:
+            matches = fnmatch.filter(top_bams, pattern)
+            if matches:
+                # Usa o primeiro match encontrado
+                bam_file = os.path.join(bam_dir, matches[0])
+                break
+        
+        # Se não encontrou, procura em todos os subdiretórios
+        if bam_file is None:
+            for file, path in all_bams:
                 # Verifica se o nome da amostra está no nome do arquivo
                 if sample in file:
-                    bam_file = os.path.join(root, file)
-                    print(f"BAM encontrado para amostra {sample}: {bam_file}")
-                    return bam_file
+                    bam_file = path
+                    break
+        
+        if bam_file:
+            print(f"BAM encontrado para amostra {sample}: {bam_file}")
+        else:
+            print(f"⚠️  Aviso: BAM não encontrado para amostra {sample} em {bam_dir}")
+        sample_bams[sample] = bam_file
     
-    print(f"⚠️  Aviso: BAM não encontrado para amostra {sample} em {bam_dir}")
-    return None
+    return sample_bams
 
-def split_vcf_by_sample(vcf_file, sample, output_dir):
-    """Separa VCF por amostra usando bcftools"""
-    output_file = os.path.join(output_dir, f"{sample}.vcf.gz")
+def ensure_bam_indexes(bam_files, jobs=1):
+    """Indexa (em paralelo) os BAMs sem índice ou com índice mais antigo que o BAM"""
+    def has_fresh_index(bam):
+        bam_mtime = os.path.getmtime(bam)
+        for index in (bam + ".bai", bam[:-4] + ".bai", bam + ".csi"):
+            if os.path.exists(index) and os.path.getmtime(index) >= bam_mtime:
+                return True
+        return False
     
+    missing = [bam for bam in bam_files if not has_fresh_index(bam)]
+    if not missing:
+        return
+    
+    print(f"Indexando {len(missing)} BAM(s) sem índice...")
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(
+            lambda bam: run_command(["samtools", "index", bam], f"Indexando {os.path.basename(bam)}"),
+            missing))
+
+def split_vcf_by_sample(vcf_file, samples, output_dir):
+    """Separa VCF por amostra usando bcftools +split (uma leitura só do VCF)"""
+    # +split grava <amostra>.bcf para cada amostra numa única passada,
+    # em vez de um bcftools view -s (que relê o VCF inteiro) por amostra.
+    # BCF sem compressão (-O u): arquivo intermediário, lido uma vez só pelo
+    # WhatsHap do início ao fim, então não precisa de BGZF nem de índice
+    cmd = [
+        "bcftools", "+split",
+        "-O", "u",
+        "-o", output_dir,
+        vcf_file
+    ]
+    
+    run_command(cmd, "Separando VCF por amostra")
+    
+    return {sample: os.path.join(output_dir, f"{sample}.bcf") for sample in samples}
+
+def get_contigs_from_vcf(vcf_file):
+    """Lista os contigs com variantes no VCF (a partir do índice)"""
+    cmd = ["bcftools", "index", "-s", vcf_file]
+    result = run_command(cmd, "Listando contigs do VCF", capture_stdout=True)
+    
+    # Linhas: contig, tamanho, nº de registros
+    contigs = [line.split('\t')[0] for line in result.stdout.decode().splitlines()
+               if line.strip()]
+    
+    print(f"Encontrados {len(contigs)} contigs: {', '.join(contigs)}")
+    return contigs
+
+def extract_sample_contig(vcf_file, sample, contig, output_dir):
+    """Extrai um contig de uma amostra (acesso aleatório pelo índice do VCF)"""
+    output_file = os.path.join(output_dir, f"{sample}.{contig}.bcf")
+    
+    # -I: AC/AN não são recalculados (o WhatsHap só lê o GT);
+    # -O u: BCF sem compressão, lido uma vez só pelo WhatsHap
     cmd = [
         "bcftools", "view",
+        "-r", contig,
         "-s", sample,
-        "-O", "z",
+        "-I",
+        "-O", "u",
         "-o", output_file,
         vcf_file
     ]
     
-    run_command(cmd, f"Separando VCF para amostra {sample}")
+    run_command(cmd, f"Extraindo {contig} da amostra {sample}")
+    
+    return output_file
+
+def concat_sample_contigs(contig_vcfs, sample, output_dir, threads=1):
+    """Junta os VCFs fasados por contig de uma amostra (na ordem dos contigs)"""
+    output_file = os.path.join(output_dir, f"{sample}_phased.vcf.gz")
+    
+    cmd = [
+        "bcftools", "concat",
+        "--threads", str(threads),
+        "-O", "z",
+        "-o", output_file
+    ] + contig_vcfs
+    
+    run_command(cmd, f"Juntando contigs fasados da amostra {sample}")
     
-    # Indexar o arquivo VCF
     cmd_index = ["bcftools", "index", "-t", output_file]
-    run_command(cmd_index, f"Indexando VCF da amostra {sample}")
+    run_command(cmd_index, f"Indexando VCF fasado da amostra {sample}")
     
     return output_file
 
-def run_whatshap_single_sample(vcf_file, bam_file, sample, output_dir, reference=None):
-    """Executa WhatsHap para uma única amostra"""
+def run_whatshap_single_sample(vcf_file, bam_file, sample, output_dir, reference=None, name=None,
+                               intermediate=False):
+    """
+    Executa WhatsHap para uma única amostra (name: prefixo dos arquivos de saída).
+    intermediate: saída só lida uma vez por um concat (VCF sem compressão e sem índice)
+    """
     if not bam_file:
         print(f"✗ Pulando amostra {sample}: BAM não encontrado")
         return None
         
-    output_file = os.path.join(output_dir, f"{sample}_phased.vcf.gz")
+    name = name or sample
+    output_file = os.path.join(output_dir, f"{name}_phased.vcf" if intermediate else f"{name}_phased.vcf.gz")
     
     cmd = [
         "whatshap", "phase",
@@ -112,34 +214,82 @@ def run_whatshap_single_sample(vcf_file, bam_file, sample, output_dir, reference
     
     cmd.extend([vcf_file, bam_file])
     
-    run_command(cmd, f"Executando WhatsHap para amostra {sample}")
+    # Log próprio por amostra: o WhatsHap escreve bastante progresso no stderr
+    log_file = os.path.join(output_dir, f"{name}_whatshap.log")
+    run_command(cmd, f"Executando WhatsHap para amostra {sample}", log_path=log_file)
     
-    # Indexar o arquivo de saída
-    cmd_index = ["bcftools", "index", "-t", output_file]
-    run_command(cmd_index, f"Indexando VCF fasado da amostra {sample}")
+    # Indexar o arquivo de saída (o merge precisa do índice; o concat, não)
+    if not intermediate:
+        cmd_index = ["bcftools", "index", "-t", output_file]
+        run_command(cmd_index, f"Indexando VCF fasado da amostra {sample}")
     
     return output_file
 
-def merge_phased_vcfs(phased_vcf_files, output_file):
+def merge_phased_vcfs(phased_vcf_files, output_file, temp_dir, threads=1):
     """Junta os arquivos VCF fasados usando bcftools merge"""
     if not phased_vcf_files:
         print("✗ Erro: Nenhum arquivo VCF fasado para juntar")
         sys.exit(1)
         
+    # Uma amostra só: não há o que juntar, o VCF fasado (já indexado) é o final
+    if len(phased_vcf_files) == 1:
+        print("Apenas um VCF fasado, movendo para a saída...")
+        shutil.move(phased_vcf_files[0], output_file)
+        shutil.move(phased_vcf_files[0] + ".tbi", output_file + ".tbi")
+        return
+    
     print("Juntando arquivos VCF fasados...")
     
+    # Lista de arquivos em disco (-l) em vez de um argumento por amostra na
+    # linha de comando (evita o limite ARG_MAX em coortes grandes)
+    file_list = os.path.join(temp_dir, "phased_vcfs.txt")
+    with open(file_list, "w") as f:
+        f.write("\n".join(phased_vcf_files) + "\n")
+    
+    # --threads: compressão BGZF da saída em paralelo
     cmd = [
         "bcftools", "merge",
+        "--threads", str(threads),
         "-O", "z",
-        "-o", output_file
-    ] + phased_vcf_files
+        "-o", output_file,
+        "-l", file_list
+    ]
     
     run_command(cmd, "Juntando arquivos VCF fasados")
     
     # Indexar o arquivo final
-    cmd_index = ["bcftools", "index", "-t", output_file]
+    cmd_index = ["bcftools", "index", "-t", "--threads", str(threads), output_file]
     run_command(cmd_index, "Indexando VCF final")
 
+def pick_scratch_dir(min_free_bytes):
+    """Escolhe um diretório local rápido para os temporários (None = padrão do tempfile)"""
+    # Disco local do nó em vez de um home em rede: os VCFs intermediários são
+    # gravados e relidos várias vezes. /dev/shm fica de fora: o +split -O u
+    # grava um BCF não comprimido por amostra e isso consumiria a RAM do nó
+    for candidate in (os.environ.get("SLURM_TMPDIR"), os.environ.get("TMPDIR")):
+        if not candidate or not os.path.isdir(candidate) or not os.access(candidate, os.W_OK):
+            continue
+        stat = os.statvfs(candidate)
+        if stat.f_bavail * stat.f_frsize >= min_free_bytes:
+            return candidate
+    return None
+
+def remove_dir_in_background(path):
+    """Remove um diretório sem esperar: renomeia e apaga num processo à parte"""
+    # O rename é só metadado (mesmo diretório pai); o rm -rf segue sozinho
+    # depois que o script termina. Se algo falhar, remove aqui mesmo
+    trash = path + ".trash"
+    try:
+        os.rename(path, trash)
+    except OSError:
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    try:
+        subprocess.Popen(["rm", "-rf", trash], start_new_session=True,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        shutil.rmtree(trash, ignore_errors=True)
+
 def main():
     parser = argparse.ArgumentParser(
         description="Processa VCF com WhatsHap separadamente por amostra",
@@ -159,12 +309,22 @@ Exemplo de uso:
     parser.add_argument("-r", "--reference",
                       help="Arquivo FASTA de referência (opcional)")
     parser.add_argument("--temp-dir",
-                      help="Diretório temporário para arquivos intermediários")
+                      help="Diretório temporário para arquivos intermediários "
+                           "(padrão: $SLURM_TMPDIR ou $TMPDIR, o primeiro com espaço livre)")
     parser.add_argument("--keep-temp", action="store_true",
                       help="Manter arquivos temporários após processamento")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                      help="Amostras processadas em paralelo (padrão: nº de CPUs)")
+    parser.add_argument("-V", "--verbose", action="store_true",
+                      help="Mostrar cada comando executado")
+    parser.add_argument("--by-chrom", action="store_true",
+                      help="Fasear cada amostra por contig em paralelo (VCF de entrada indexado)")
     
     args = parser.parse_args()
     
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(message)s")
+    
     # Verificar se arquivo VCF existe
     if not os.path.exists(args.vcf):
         print(f"Erro: Arquivo VCF não encontrado: {args.vcf}")
@@ -180,10 +340,9 @@ Exemplo de uso:
         sys.exit(1)
     
     # Verificar se ferramentas estão disponíveis
+    # (shutil.which só procura no PATH, sem abrir um processo por ferramenta)
     for tool in ["bcftools", "whatshap"]:
-        try:
-            subprocess.run([tool, "--version"], capture_output=True, check=True)
-        except (subprocess.CalledProcessError, FileNotFoundError):
+        if shutil.which(tool) is None:
             print(f"Erro: {tool} não está instalado ou não está no PATH")
             sys.exit(1)
     
@@ -192,7 +351,8 @@ Exemplo de uso:
         temp_dir = args.temp_dir
         os.makedirs(temp_dir, exist_ok=True)
     else:
-        temp_dir = tempfile.mkdtemp(prefix="whatshap_")
+        temp_dir = tempfile.mkdtemp(prefix="whatshap_",
+                                    dir=pick_scratch_dir(os.path.getsize(args.vcf) * 3 // 2))
     
     print(f"Usando diretório temporário: {temp_dir}")
     
@@ -206,10 +366,7 @@ Exemplo de uso:
         
         # 2. Encontrar arquivos BAM para cada amostra
         print("\n=== Mapeando BAMs para amostras ===")
-        sample_bams = {}
-        for sample in samples:
-            bam_file = find_bam_for_sample(sample, args.bam_dir)
-            sample_bams[sample] = bam_file
+        sample_bams = build_bam_index(args.bam_dir, samples)
         
         # Verificar se pelo menos um BAM foi encontrado
         found_bams = [bam for bam in sample_bams.values() if bam is not None]
@@ -219,34 +376,73 @@ Exemplo de uso:
         
         print(f"Encontrados {len(found_bams)} de {len(samples)} arquivos BAM")
         
-        # 3. Separar VCF por amostra
-        print("\n=== Separando VCF por amostra ===")
-        sample_vcfs = {}
-        for sample in samples:
-            sample_vcf = split_vcf_by_sample(args.vcf, sample, temp_dir)
-            sample_vcfs[sample] = sample_vcf
+        # Índices dos BAMs prontos antes do WhatsHap (todos de uma vez, em paralelo)
+        ensure_bam_indexes(found_bams, args.jobs)
+        
+        # 3. Separar VCF por amostra (uma passada); com uma amostra só o
+        # WhatsHap lê o VCF de entrada direto. Por contig (--by-chrom), cada
+        # tarefa extrai o seu pedaço pelo índice e dispensa a separação
+        if args.by_chrom:
+            contigs = get_contigs_from_vcf(args.vcf)
+        elif len(samples) == 1:
+            sample_vcfs = {samples[0]: args.vcf}
+        else:
+            print("\n=== Separando VCF por amostra ===")
+            sample_vcfs = split_vcf_by_sample(args.vcf, samples, temp_dir)
         
-        # 4. Executar WhatsHap para cada amostra
-        print("\n=== Executando WhatsHap por amostra ===")
-        phased_vcfs = []
-        for sample in samples:
-            print(f"\nProcessando amostra: {sample}")
-            if sample_bams[sample]:
-                phased_vcf = run_whatshap_single_sample(
-                    sample_vcfs[sample], 
+        # Amostras são independentes (cada uma roda seu próprio whatshap),
+        # então o passo 4 roda em paralelo
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            # 4. Executar WhatsHap para cada amostra
+            print("\n=== Executando WhatsHap por amostra ===")
+            to_phase = []
+            for sample in samples:
+                if sample_bams[sample]:
+                    to_phase.append(sample)
+                else:
+                    print(f"✗ Pulando amostra {sample}: BAM não encontrado")
+            
+            def phase(sample):
+                print(f"\nProcessando amostra: {sample}")
+                return run_whatshap_single_sample(
+                    sample_vcfs[sample],
                     sample_bams[sample],
-                    sample, 
+                    sample,
                     temp_dir,
                     args.reference
                 )
-                if phased_vcf:
-                    phased_vcfs.append(phased_vcf)
+            
+            def phase_contig(task):
+                sample, contig = task
+                print(f"\nProcessando amostra: {sample} ({contig})")
+                contig_vcf = extract_sample_contig(args.vcf, sample, contig, temp_dir)
+                return run_whatshap_single_sample(
+                    contig_vcf,
+                    sample_bams[sample],
+                    sample,
+                    temp_dir,
+                    args.reference,
+                    name=f"{sample}.{contig}",
+                    intermediate=True
+                )
+            
+            if args.by_chrom:
+                # Contig x amostra: todas as tarefas no mesmo pool, depois
+                # um concat por amostra (contigs na ordem do índice)
+                tasks = [(sample, contig) for sample in to_phase for contig in contigs]
+                contig_vcfs = dict(zip(tasks, executor.map(phase_contig, tasks)))
+                phased_vcfs = list(executor.map(
+                    lambda sample: concat_sample_contigs(
+                        [contig_vcfs[(sample, contig)] for contig in contigs],
+                        sample, temp_dir),
+                    to_phase))
             else:
-                print(f"✗ Pulando amostra {sample}: BAM não encontrado")
+                # map mantém a ordem das amostras para o merge
+                phased_vcfs = [vcf for vcf in executor.map(phase, to_phase) if vcf]
         
         # 5. Juntar arquivos VCF fasados
         print("\n=== Juntando resultados ===")
-        merge_phased_vcfs(phased_vcfs, args.output)
+        merge_phased_vcfs(phased_vcfs, args.output, temp_dir, args.jobs)
         
         print(f"\n✓ Processamento concluído!")
         print(f"Arquivo de saída: {args.output}")
@@ -263,7 +459,7 @@ Exemplo de uso:
         # Limpar arquivos temporários se solicitado
         if not args.keep_temp and not args.temp_dir:
             print(f"\nRemovendo arquivos temporários...")
-            shutil.rmtree(temp_dir, ignore_errors=True)
+            remove_dir_in_background(temp_dir)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file